@@ -12,8 +12,4 @@ if [[ "$dest" == '' ]] ; then
     exit 1
 fi
 
-for file in "$@" ; do
-    name=$(basename "$file" .swi)
-    echo "+++ Processing $name from $file"
-    python oslib_parser.py --create-aarch64-api "$dest/$name.s" "$file"
-done
+python oslib_parser.py --output-dir "$dest" --generate aarch64-api --output-pattern "aarch64-api={name}.s" "$@"
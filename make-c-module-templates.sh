@@ -20,44 +20,20 @@ elif [[ -x ./vmanage ]] ; then
 fi
 
 
-for file in "$@" ; do
-    name=$(basename "$file" .swi)
-
-    # Skip anything that isn't really a module
-    if [[ "$file" =~ /OS[^/]*\.swi ]] ; then
-        continue
-    fi
-    if [[ "$file" =~ /Wimp[^/][^/]*\.swi ]] ; then
-        # Any of the sub-files for the Wimp
-        continue
-    fi
-    # Failing modules at the moment:
-    #   ConvertSprite (reuse of the variable 'regs')
-    #   DiagnosticDump (reuse of the variable 'regs')
-    #   DrawFile (Draw_PathElement is referenced within Draw_PathElement)
-    #   FileSwitch (wrong CMHG SWI chunk base)
-    #   ImageFileConvert (misinterpreted Void type)
-    #   ImageFileRender (misinterpreted .int type)
-    #   InverseTable (misinterpreted OSSpriteOp_Area type - should be .Ref?)
-    #   PDriver (misinterpreted .int type, Draw_PathElement referenced within Draw_PathElement)
-    #   ZapFontMenu (wrong CMHG SWI chunk base)
-
-    # Skip any Toolbox modules, as there's no need to rebuild them
-    # (and they give us errors about wrong SWI chunk bases)
-    if [[ "$file" =~ /Toolbox/ ]] ; then
-        continue
-    fi
-
-    OSLIB_DIR=$(dirname "$(dirname "$(dirname "$file")")")
-    echo "+++ Processing $name from $file"
-    mkdir -p "$dest/$name/cmhg"
-    mkdir -p "$dest/$name/c"
-    mkdir -p "$dest/$name/h"
-    python oslib_parser.py --create-module-cmhg-template "$dest/$name/cmhg/modhead" "$file" --oslib-dir "$OSLIB_DIR"
-    python oslib_parser.py --create-module-c-template "$dest/$name/c/module" "$file" --oslib-dir "$OSLIB_DIR"
-    python oslib_parser.py --create-module-h-template "$dest/$name/h/types" "$file" --oslib-dir "$OSLIB_DIR"
-    if [[ "$VMANAGE" != '' ]] ; then
-        # VManage can be located https://github.com/gerph/riscos-vmanage
-        ( cd "$dest/$name" ; $VMANAGE init )
-    fi
-done
+# The modules which are skipped (because they aren't really modules, or don't need to be
+# rebuilt) are decided by oslib_parser.py.
+python oslib_parser.py --output-dir "$dest" \
+                       --generate module-cmhg-template --output-pattern "module-cmhg-template={name}/cmhg/modhead" \
+                       --generate module-c-template --output-pattern "module-c-template={name}/c/module" \
+                       --generate module-h-template --output-pattern "module-h-template={name}/h/types" \
+                       "$@"
+
+if [[ "$VMANAGE" != '' ]] ; then
+    for file in "$@" ; do
+        name=$(basename "$file" .swi)
+        if [[ -d "$dest/$name" ]] ; then
+            # VManage can be located https://github.com/gerph/riscos-vmanage
+            ( cd "$dest/$name" ; $VMANAGE init )
+        fi
+    done
+fi
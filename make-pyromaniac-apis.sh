@@ -12,8 +12,4 @@ if [[ "$dest" == '' ]] ; then
     exit 1
 fi
 
-for file in "$@" ; do
-    name=$(basename "$file" .swi)
-    echo "+++ Processing $name from $file"
-    python oslib_parser.py --create-api-template "$dest/$name.py" "$file"
-done
+python oslib_parser.py --output-dir "$dest" --generate api-template --output-pattern "api-template={name}.py" "$@"
@@ -4,13 +4,21 @@ Parse an OSLib definition file, and generate API and module definitions.
 """
 
 import argparse
+import copy
 import datetime
 import functools
+import hashlib
+import io
+import json
 import math
 import os
+import pickle
 import re
+import stat
 import sys
+import tempfile
 import time
+import weakref
 
 
 # Whether we debug the parser
@@ -38,7 +46,20 @@ class ParseError(Exception):
         return self.args
 
 
+class LayoutError(Exception):
+    pass
+
+
+class ConstantError(Exception):
+    pass
+
+
+class ServerError(Exception):
+    pass
+
+
 class Union(object):
+    __slots__ = ('name', 'members', '__weakref__')
 
     def __init__(self, name=None):
         self.name = name
@@ -54,6 +75,7 @@ class Union(object):
 
 
 class Array(object):
+    __slots__ = ('dtype', 'nelements', '__weakref__')
 
     def __init__(self, dtype, elements):
         self.dtype = dtype
@@ -66,6 +88,7 @@ class Array(object):
 
 
 class Struct(object):
+    __slots__ = ('name', 'members', '__weakref__')
 
     def __init__(self, name=None):
         self.name = name
@@ -81,6 +104,7 @@ class Struct(object):
 
 
 class Member(object):
+    __slots__ = ('dtype', 'name', 'array')
 
     def __init__(self, dtype, name, array=None):
         self.dtype = dtype
@@ -96,6 +120,7 @@ class Member(object):
 
 @functools.total_ordering
 class Constant(object):
+    __slots__ = ('name', 'dtype', 'value')
 
     def __init__(self, name, dtype, value):
         self.name = name
@@ -122,12 +147,14 @@ class Constant(object):
             a = a[0]
         if isinstance(b, list):
             b = b[0]
-        if a == b:
+        if a == b or not (isinstance(a, int) and isinstance(b, int)):
+            # Expressions cannot be compared without evaluating them
             return self.name < other.name
         return a < b
 
 
 class Register(object):
+    __slots__ = ('reg', 'assign', 'dtype', 'name', 'returned', 'corrupted')
 
     def __init__(self, reg, assign, dtype, name, returned=False, corrupted=False):
         self.reg = reg
@@ -150,6 +177,8 @@ class Register(object):
 
 
 class SWI(object):
+    __slots__ = ('name', 'defname', 'number', 'description', 'starred', 'hidden',
+                 'entry', 'exit', 'returned', '_inregs', '_outregs')
 
     def __init__(self, name):
         self.name = name
@@ -162,6 +191,9 @@ class SWI(object):
         self.entry = []
         self.exit = []
         self.returned = None
+        # Register mappings, calculated when first needed
+        self._inregs = None
+        self._outregs = {}
 
     def __repr__(self):
         if self.hidden:
@@ -174,16 +206,29 @@ class SWI(object):
 
     def add_entry(self, reg):
         self.entry.append(reg)
-        # Create a dictionary of the registers as well?
+        self._inregs = None
+        self._outregs = {}
 
     def add_exit(self, reg):
         self.exit.append(reg)
-        # Create a dictionary of the registers as well?
+        self._outregs = {}
 
     def set_return(self, reg):
         self.returned = reg
 
     def inregs(self):
+        """
+        Return the mapping of the entry registers to the arguments.
+
+        The mapping is cached, so must not be modified.
+
+        @return: dictionary of argument number (or -1 for constants) to list of registers
+        """
+        if self._inregs is None:
+            self._inregs = self._build_inregs()
+        return self._inregs
+
+    def _build_inregs(self):
         inregs = {}
         nreg = 0
         lastreg = None
@@ -211,6 +256,23 @@ class SWI(object):
         return inregs
 
     def outregs(self, x_variant):
+        """
+        Return the mapping of the exit registers to the arguments.
+
+        The mapping is cached, so must not be modified.
+
+        @param x_variant:   True for the X form of the SWI, in which the returned register is present
+
+        @return: dictionary of argument number to register
+        """
+        x_variant = bool(x_variant)
+        outregs = self._outregs.get(x_variant)
+        if outregs is None:
+            outregs = self._build_outregs(x_variant)
+            self._outregs[x_variant] = outregs
+        return outregs
+
+    def _build_outregs(self, x_variant):
         outregs = {}
         nreg = len([reg for reg in self.inregs() if reg != -1])
         for reg in self.exit:
@@ -223,7 +285,26 @@ class SWI(object):
         return outregs
 
 
+def lazy_swis(attr):
+    """
+    Property for the SWI definitions, which parses any deferred SWI statements first.
+    """
+    def get(self):
+        if self._pending_swis:
+            self.parse_pending_swis()
+        return getattr(self, attr)
+    return property(get)
+
+
 class DefMod(object):
+    # The SWI definitions, which might not have been parsed yet
+    swis = lazy_swis('_swis')
+    interfaces = lazy_swis('_interfaces')
+    modswis = lazy_swis('_modswis')
+    vectors = lazy_swis('_vectors')
+    services = lazy_swis('_services')
+    events = lazy_swis('_events')
+    upcalls = lazy_swis('_upcalls')
 
     def __init__(self, name, modname=None, inctype='required'):
         modname = modname.lower()
@@ -239,17 +320,25 @@ class DefMod(object):
         self.types = {}
         self.needs = []
         self.types = {}
-        self.swis = {}  # All of the SWI definitions
+        self._swis = {}  # All of the SWI definitions
 
         # All the interfaces (swis, vectors, service, events, upcalls)
-        self.interfaces = {}
+        self._interfaces = {}
 
         # Special cases of swis (the entries are also in SWIs):
-        self.modswis = {}  # Just the SWIs for this module
-        self.vectors = {}
-        self.services = {}
-        self.events = {}
-        self.upcalls = {}
+        self._modswis = {}  # Just the SWIs for this module
+        self._vectors = {}
+        self._services = {}
+        self._events = {}
+        self._upcalls = {}
+
+        # StatementRecords for the SWI statements which have not been parsed yet
+        self._pending_swis = []
+        # Whether the SWI statements are left until they are used
+        self.lazy = False
+
+        # StatementRecords for the statements of the def file, in order
+        self.statements = []
 
     def __repr__(self):
         return "<DefMod(%r, %i constants)>" % (self.title, len(self.constants))
@@ -273,44 +362,169 @@ class DefMod(object):
         self.types[name] = dtype
 
     def add_swi(self, swi):
-        if swi.name in self.interfaces:
-            print("Redefinition of SWI %x : %r / %r" % (swi.number, swi, self.interfaces[swi.name]))
-        self.interfaces[swi.name] = swi
+        if swi.name in self._interfaces:
+            print("Redefinition of SWI %x : %r / %r" % (swi.number, swi, self._interfaces[swi.name]))
+        self._interfaces[swi.name] = swi
 
         if swi.name.startswith("Service_"):
-            swilist = self.services
+            swilist = self._services
             swi.name = "OS_ServiceCall_" + swi.name[8:]
         elif swi.name.startswith("Event_"):
-            swilist = self.events
+            swilist = self._events
             swi.name = "OS_Generate" + swi.name
         elif swi.name.startswith("UpCall_"):
             swi.name = "OS_" + swi.name
-            swilist = self.upcalls
+            swilist = self._upcalls
         elif swi.name.endswith("V") and "_" not in swi.name:
             swi.name = "OS_CallVector_" + swi.name
-            swilist = self.vectors
+            swilist = self._vectors
         else:
-            swilist = self.modswis
+            swilist = self._modswis
 
         if swi.number in swilist:
             swilist[swi.number].append(swi)
         else:
             swilist[swi.number] = [swi]
 
-        swilist = self.swis
+        swilist = self._swis
         if swi.number in swilist:
             swilist[swi.number].append(swi)
         else:
             swilist[swi.number] = [swi]
 
+    def add_event(self, event):
+        """
+        Add the definition from a ParseEvent to the module.
+
+        @param event:   ParseEvent from iter_statements
+        """
+        kind = event.kind
+        if kind == 'constant':
+            self.add_constant(event.value)
+        elif kind == 'type':
+            self.add_type(*event.value)
+        elif kind == 'swi':
+            self.add_swi(event.value)
+        elif kind == 'needs':
+            self.add_need(event.value)
+        elif kind == 'title':
+            self.title = event.value
+        elif kind == 'deferred':
+            (text, start, end) = event.value
+            self._pending_swis.append(StatementRecord(None, start, end, event.lineno, [event]))
+        else:
+            raise ValueError("Unknown parse event '%s'" % (kind,))
+
+    def add_statement(self, record):
+        """
+        Add the definitions from a statement to the module.
+
+        @param record:  StatementRecord from parse_statements
+        """
+        self.statements.append(record)
+        for event in record.events:
+            if event.kind == 'deferred':
+                self._pending_swis.append(record)
+            else:
+                self.add_event(event)
+
+    def reparse(self, text):
+        """
+        Update the module from a new version of its def file, parsing only the statements
+        which have changed.
+
+        The definitions from unchanged statements keep their existing objects. The
+        dictionaries are refilled in place, in the order of the statements, so that
+        copies of the module share the changes.
+
+        @param text:    The text of the def file, from read_def_file
+
+        @return: number of statements which were parsed
+        """
+        statements = self.statements
+        previous = {}
+        for record in statements:
+            previous.setdefault(record.digest, []).append(record)
+
+        # Changed SWI statements are only deferred if none have been parsed, to keep their order
+        defer_swis = self.lazy and (self.swis_pending or not self._swis)
+        records = list(parse_statements(text, defer_swis=defer_swis, previous=previous))
+        existing = set(id(record) for record in statements)
+        parsed = 0
+        for record in records:
+            if id(record) not in existing:
+                type_symbols.intern_events(record.events)
+                parsed += 1
+        if not parsed and len(records) == len(statements) and \
+           all(new is old for new, old in zip(records, statements)):
+            # Only the positions of the statements have changed
+            return 0
+
+        self.title = None
+        self.constants.clear()
+        self.types.clear()
+        del self.needs[:]
+        for swilist in (self._swis, self._interfaces, self._modswis, self._vectors,
+                        self._services, self._events, self._upcalls):
+            swilist.clear()
+        del self._pending_swis[:]
+        del statements[:]
+
+        for record in records:
+            for event in record.events:
+                if event.kind == 'swi':
+                    # Undo the renaming by add_swi
+                    event.value.name = event.value.defname
+            self.add_statement(record)
+
+        return parsed
+
+    @property
+    def swis_pending(self):
+        return bool(self._pending_swis)
+
+    def parse_pending_swis(self):
+        """
+        Parse the SWI statements which were deferred.
+
+        The definitions are added to the dictionaries in place, so copies of the
+        module share them. Nothing is added unless every statement can be parsed,
+        so a failure is raised again each time the SWIs are used.
+        """
+        parsed = []
+        lineno = 0
+        try:
+            for record in self._pending_swis:
+                lineno = record.lineno
+                (text, start, end) = record.events[0].value
+                events = StatementEvents(lineno)
+                Statement(events, text, start, end)
+                parsed.append((record, events.events))
+        except ParseError as exc:
+            exc.lineno = lineno
+            raise
+
+        del self._pending_swis[:]
+        for record, events in parsed:
+            record.events = events
+            for event in events:
+                self.add_event(event)
+        for swilist in self._swis.values():
+            for swi in swilist:
+                type_symbols.intern_swi(swi)
+
 
 class Statement(object):
-    token_re = re.compile(r'^(\.?[A-Za-z_][A-Za-z_0-9]*|(?:&|0x)[0-9A-Fa-f]+|\.\.\.|%[01]+|0b[01]+|-?[0-9]+|[!\?:,\(\)=\|\[\]#\*\+]|->|"[^"]*"|\'[^\']*\')')
+    token_re = re.compile(r'\s*(\.?[A-Za-z_][A-Za-z_0-9]*|(?:&|0x)[0-9A-Fa-f]+|\.\.\.|%[01]+|0b[01]+|-?[0-9]+|[!\?:,\(\)=\|\[\]#\*\+]|->|<<|>>|"[^"]*"|\'[^\']*\')')
+    space_re = re.compile(r'\s*')
+    # Line breaks within quoted strings are collapsed to a single space
+    newline_re = re.compile(r'\s*\n\s*')
 
-    def __init__(self, defmod, lines):
-        self.lines = lines
+    def __init__(self, defmod, text, start=0, end=None):
         self.defmod = defmod
-        if True:
+        self.tokens = self.tokenise(text, start, end)
+        self.pos = 0
+        if self.tokens:
             tok = self.token()
             if debug:
                 print("Statement: %s" % (tok,))
@@ -322,6 +536,39 @@ class Statement(object):
                 if debug:
                     print("  not parseable")
 
+    @classmethod
+    def tokenise(cls, text, start=0, end=None):
+        """
+        Split the statement text into a list of tokens, in a single pass.
+
+        @param text:    The text to tokenise
+        @param start:   Offset of the start of the statement within the text
+        @param end:     Offset of the end of the statement within the text
+
+        @return: list of token strings
+        """
+        if end is None:
+            end = len(text)
+        tokens = []
+        token_match = cls.token_re.match
+        pos = start
+        while pos < end:
+            match = token_match(text, pos, end)
+            if not match:
+                pos = cls.space_re.match(text, pos, end).end()
+                if pos == end:
+                    break
+                line_end = text.find('\n', pos, end)
+                if line_end == -1:
+                    line_end = end
+                raise ParseError("Cannot process token from line: %r" % (text[pos:line_end],))
+            tok = match.group(1)
+            if '\n' in tok:
+                tok = cls.newline_re.sub(' ', tok)
+            tokens.append(tok)
+            pos = match.end()
+        return tokens
+
     def list_tokens(self, label='Tokens'):
         print("%s:" % (label,))
         while True:
@@ -331,29 +578,21 @@ class Statement(object):
             print("  '%s'" % (tok,))
 
     def token(self):
-        while self.lines:
-            line = self.lines[0].strip()
-            if not line:
-                self.lines.pop(0)
-            else:
-                match = self.token_re.search(line)
-                if match:
-                    tok = match.group(1)
-                    line = line[len(tok):]
-                    self.lines[0] = line
-                    return tok
-                else:
-                    if len(self.lines) > 1:
-                        line = line + ' ' + self.lines.pop(1).lstrip()
-                        self.lines[0] = line
-                    else:
-                        raise ParseError("Cannot process token from line: %r" % (line,))
+        pos = self.pos
+        if pos < len(self.tokens):
+            self.pos = pos + 1
+            return self.tokens[pos]
 
         return None
 
     def push_token(self, tok):
         if tok:
-            self.lines.insert(0, tok)
+            pos = self.pos
+            if pos and self.tokens[pos - 1] == tok:
+                # Returning the token we just read, so we can just step back
+                self.pos = pos - 1
+            else:
+                self.tokens.insert(pos, tok)
 
     def token_group(self, terminal):
         """
@@ -743,62 +982,481 @@ class Statement(object):
                 break
 
 
-def parse_file(filename, name=None, inctype='required'):
-    if name is None:
-        name = os.path.basename(filename).title()
+# Comments run to the end of the line, even within quoted strings
+comment_re = re.compile(r'//[^\n]*')
+# The characters which change the state of the statement splitter
+statement_split_re = re.compile(r'[";\n]')
 
-    defmod = DefMod(name, modname=name.lower(), inctype=inctype)
 
-    lineno = 0
-    try:
-        with open_ro(filename) as fh:
-            accumulator = []
-            inquotes = False
-            for line in fh:
-                lineno += 1
-
-                # Replace any hard spaces with regular spaces
-                line = line.replace('\xa0', ' ')
-                line = line.rstrip('\n')
-                if '//' in line:
-                    before, after = line.split('//', 1)
-                    line = before
-                while ';' in line:
-                    before, after = line.split(';', 1)
-                    quotes_present = len(before.split('"')) - 1
-                    if quotes_present & 1:
-                        inquotes = not inquotes
-
-                    if inquotes:
-                        # This is a ; in a quoted string, so we need to just move it to the accumulator
-                        # so that we can skip it nicely.
-                        accumulator.append(before)
-                        line = after
-                        continue
+# The start of a SWI statement, which may be parsed later
+swi_statement_re = re.compile(r'\s*SWI(?![A-Za-z_0-9])', re.IGNORECASE)
+
+
+def split_statements(text):
+    """
+    Split the text of a def file into statements, in a single pass.
+
+    Statements are terminated by a ';' which is not within a quoted string.
+    Comments must already have been removed from the text.
+
+    @param text:    The text of the file
+
+    @yield: tuple of (start, end, lineno) giving the offsets of the statement
+            within the text and the line number that the statement ends on
+    """
+    inquotes = False
+    start = 0
+    lineno = 1
+    for match in statement_split_re.finditer(text):
+        char = match.group()
+        if char == '\n':
+            lineno += 1
+        elif char == '"':
+            inquotes = not inquotes
+        elif not inquotes:
+            end = match.start()
+            yield (start, end, lineno)
+            start = end + 1
+
+    if start < len(text):
+        yield (start, len(text), lineno)
+
+
+class ParseEvent(object):
+    """
+    A definition from a def file, produced as each statement is parsed.
+
+    The kinds of event, and their values, are:
+        'title':    the title of the module
+        'needs':    the name of a module which is needed
+        'constant': a Constant
+        'type':     a tuple of (name, dtype)
+        'swi':      a SWI, with the name as it was defined
+        'deferred': a tuple of (text, start, end) for a SWI statement which was not parsed
+    """
+    __slots__ = ('kind', 'value', 'lineno')
+
+    def __init__(self, kind, value, lineno=None):
+        self.kind = kind
+        self.value = value
+        self.lineno = lineno
+
+    def __repr__(self):
+        return "<{}({}, {!r}, line {})>".format(self.__class__.__name__,
+                                                self.kind, self.value, self.lineno)
+
+
+class StatementRecord(object):
+    """
+    A statement from a def file, and the definitions that it produced.
+    """
+    __slots__ = ('digest', 'start', 'end', 'lineno', 'events')
+
+    def __init__(self, digest, start, end, lineno, events):
+        self.digest = digest    # Digest of the statement's text, or None if not known
+        self.start = start      # Offset of the start of the statement within the text
+        self.end = end          # Offset of the end of the statement within the text
+        self.lineno = lineno    # Line number that the statement ends on
+        self.events = events    # ParseEvents for the definitions
+
+    def __repr__(self):
+        return "<{}(line {}, {} events)>".format(self.__class__.__name__,
+                                                 self.lineno, len(self.events))
+
+
+class StatementEvents(object):
+    """
+    Stands in for the DefMod whilst a statement is parsed, collecting its definitions as events.
+    """
+
+    def __init__(self, lineno):
+        self.lineno = lineno
+        self.events = []
+        self._title = None
+
+    @property
+    def title(self):
+        return self._title
 
-                    line = after
-                    accumulator.append(before)
-                    Statement(defmod, accumulator)
-                    accumulator = []
+    @title.setter
+    def title(self, title):
+        self._title = title
+        self.events.append(ParseEvent('title', title, self.lineno))
 
-                if line:
-                    accumulator.append(line)
+    def add_constant(self, const):
+        self.events.append(ParseEvent('constant', const, self.lineno))
+
+    def add_need(self, need):
+        self.events.append(ParseEvent('needs', need, self.lineno))
+
+    def add_type(self, name, dtype):
+        self.events.append(ParseEvent('type', (name, dtype), self.lineno))
+
+    def add_swi(self, swi):
+        self.events.append(ParseEvent('swi', swi, self.lineno))
+
+
+def read_def_file(filename):
+    """
+    Read the text of a def file, ready to be split into statements.
+
+    @param filename:    The def file to read
+
+    @return: text of the file, without comments
+    """
+    with open_ro(filename) as fh:
+        text = fh.read()
+
+    # Replace any hard spaces with regular spaces
+    text = text.replace('\xa0', ' ')
+    if '//' in text:
+        text = comment_re.sub('', text)
+    return text
+
+
+def parse_statements(text, defer_swis=False, previous=None):
+    """
+    Parse the text of a def file, producing a record of each statement as it is parsed.
 
-                quotes_present = len(line.split('"')) - 1
-                if quotes_present & 1:
-                    inquotes = not inquotes
+    @param text:        The text of the def file, from read_def_file
+    @param defer_swis:  Whether the SWI statements are given 'deferred' events,
+                        rather than being parsed
+    @param previous:    Dictionary of the StatementRecords from an earlier parse,
+                        as lists keyed by digest; statements which are found here
+                        are reused (and removed) rather than being parsed again
 
-        if accumulator:
-            Statement(defmod, accumulator)
+    @yield: StatementRecord for each statement
+    """
+    lineno = 0
+    try:
+        for start, end, lineno in split_statements(text):
+            statement = text[start:end].strip()
+            if not statement:
+                continue
+            if not isinstance(statement, bytes):
+                # Python 3 text, as read in latin-1
+                statement = statement.encode('latin-1')
+            digest = hashlib.sha1(statement).digest()
+
+            if previous:
+                records = previous.get(digest)
+                if records:
+                    record = records.pop(0)
+                    record.start = start
+                    record.end = end
+                    record.lineno = lineno
+                    if record.events and record.events[0].kind == 'deferred':
+                        record.events = [ParseEvent('deferred', (text, start, end), lineno)]
+                    yield record
+                    continue
+
+            if defer_swis and swi_statement_re.match(text, start, end):
+                events = [ParseEvent('deferred', (text, start, end), lineno)]
+            else:
+                recorder = StatementEvents(lineno)
+                Statement(recorder, text, start, end)
+                events = recorder.events
+            yield StatementRecord(digest, start, end, lineno, events)
     except ParseError as exc:
         exc.lineno = lineno
         raise
 
+
+def iter_statements(filename, defer_swis=False):
+    """
+    Parse a def file, producing the definitions as each statement is parsed.
+
+    Nothing is retained between statements, so the caller may stop at any point,
+    and only keeps the definitions that it wants.
+
+    @param filename:    The def file to parse
+    @param defer_swis:  Whether the SWI statements are produced as 'deferred' events,
+                        rather than being parsed
+
+    @yield: ParseEvent for each definition
+    """
+    for record in parse_statements(read_def_file(filename), defer_swis=defer_swis):
+        for event in record.events:
+            yield event
+
+
+def iter_interfaces(filename):
+    """
+    Parse a def file, producing the SWIs as each is parsed.
+
+    @param filename:    The def file to parse
+
+    @yield: SWI objects, with the names as they were defined
+    """
+    for event in iter_statements(filename):
+        if event.kind == 'swi':
+            yield event.value
+
+
+try:
+    intern = sys.intern
+except AttributeError:
+    # Python 2 has intern as a builtin
+    pass
+
+
+class TypeSymbols(object):
+    """
+    Symbol table for the types used by the parsed modules.
+
+    Type names are interned, and their lower case forms computed only once. Struct,
+    Union and Array types which are structurally identical are hash-consed, so that
+    each shape is only stored once, and types can be compared by identity.
+    """
+
+    def __init__(self):
+        self.lower_names = {}
+        # Shapes are only kept whilst something uses them, so that types which are replaced
+        # when a module is reparsed can be freed
+        self.nodes = weakref.WeakValueDictionary()
+
+    def __repr__(self):
+        return "<{}({} names, {} shapes)>".format(self.__class__.__name__,
+                                                  len(self.lower_names), len(self.nodes))
+
+    def lower(self, name):
+        """
+        Return the interned lower case form of a type name.
+        """
+        lowered = self.lower_names.get(name)
+        if lowered is None:
+            lowered = intern(name.lower())
+            self.lower_names[name] = lowered
+        return lowered
+
+    def dtype(self, dtype):
+        """
+        Return the canonical form of a type.
+
+        @param dtype:   A type name, or a Struct, Union or Array
+
+        @return: the interned name, or the shared type node with the same shape
+        """
+        if isinstance(dtype, str):
+            return intern(dtype)
+
+        if isinstance(dtype, Array):
+            dtype.dtype = self.dtype(dtype.dtype)
+            nelements = dtype.nelements
+            if isinstance(nelements, list):
+                nelements = tuple(nelements)
+            key = (Array, id(dtype.dtype), nelements)
+        elif isinstance(dtype, (Struct, Union)):
+            for member in dtype.members:
+                member.dtype = self.dtype(member.dtype)
+            key = (dtype.__class__, dtype.name,
+                   tuple((id(member.dtype), member.name, member.array) for member in dtype.members))
+        else:
+            return dtype
+
+        # Each node keeps the nodes in its key alive, so the ids remain valid for as long
+        # as the entry is present
+        return self.nodes.setdefault(key, dtype)
+
+    def intern_defmod(self, defmod):
+        """
+        Replace the types used in a module with their canonical forms.
+        """
+        # Updated in place, as copies of the module may share the dictionary
+        types = dict((intern(name), self.dtype(dtype)) for name, dtype in defmod.types.items())
+        defmod.types.clear()
+        defmod.types.update(types)
+        for constant in defmod.constants.values():
+            constant.dtype = self.dtype(constant.dtype)
+        if not defmod.swis_pending:
+            # Deferred SWIs are interned when they are parsed
+            for swilist in defmod.swis.values():
+                for swi in swilist:
+                    self.intern_swi(swi)
+        # The statement records are used again by DefMod.reparse
+        for record in defmod.statements:
+            for event in record.events:
+                if event.kind == 'type':
+                    (name, dtype) = event.value
+                    event.value = (intern(name), self.dtype(dtype))
+
+    def intern_events(self, events):
+        """
+        Replace the types used in the definitions from a statement with their canonical forms.
+
+        @param events:  list of ParseEvents
+        """
+        for event in events:
+            kind = event.kind
+            if kind == 'type':
+                (name, dtype) = event.value
+                event.value = (intern(name), self.dtype(dtype))
+            elif kind == 'constant':
+                event.value.dtype = self.dtype(event.value.dtype)
+            elif kind == 'swi':
+                self.intern_swi(event.value)
+
+    def intern_swi(self, swi):
+        for reg in swi.entry:
+            reg.dtype = self.dtype(reg.dtype)
+        for reg in swi.exit:
+            reg.dtype = self.dtype(reg.dtype)
+
+
+# The symbol table shared by everything parsed in this process
+type_symbols = TypeSymbols()
+
+
+def parser_source():
+    """
+    Return the filename of this parser's source, rather than its compiled form.
+    """
+    source = __file__
+    if source.endswith(('.pyc', '.pyo')):
+        source = source[:-1]
+    return source
+
+
+class ParseCache(object):
+    """
+    Cache of parsed DefMod objects, stored on disk.
+
+    Entries are keyed by the content of the def file and the version of this parser,
+    so a change to either will cause the file to be parsed again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._version = None
+
+    def __repr__(self):
+        return "<{}({!r})>".format(self.__class__.__name__, self.path)
+
+    @property
+    def version(self):
+        """
+        Digest of the parser source, so that parser changes invalidate the cache.
+        """
+        if self._version is None:
+            digest = hashlib.sha1()
+            digest.update(('%s:%s:%s' % (__name__, sys.version_info[0], pickle.HIGHEST_PROTOCOL)).encode('utf-8'))
+            with open(parser_source(), 'rb') as fh:
+                digest.update(fh.read())
+            self._version = digest.hexdigest()
+        return self._version
+
+    def key(self, filename, name, lazy=False):
+        """
+        Return the cache key for a given def file.
+
+        @param filename:    The def file to be parsed
+        @param name:        The name that the DefMod will be given
+        @param lazy:        Whether the SWI statements are left until they are used
+
+        @return: hex string key
+        """
+        digest = hashlib.sha1()
+        digest.update(('%s:%s:%s:' % (self.version, name, 'lazy' if lazy else 'eager')).encode('utf-8'))
+        with open(filename, 'rb') as fh:
+            digest.update(fh.read())
+        return digest.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.path, key[:2], key + '.pickle')
+
+    def load(self, key):
+        """
+        Return the cached DefMod for a key, or None if it is not present.
+        """
+        try:
+            with open(self.filename(key), 'rb') as fh:
+                return pickle.load(fh)
+        except Exception as exc:
+            # Missing or unreadable cache entries are just parsed again
+            if debug and not isinstance(exc, (IOError, OSError)):
+                print("Cache entry %s unusable: %s" % (key, exc))
+            return None
+
+    def save(self, key, defmod):
+        """
+        Store a DefMod in the cache.
+        """
+        filename = self.filename(key)
+        dirname = os.path.dirname(filename)
+        try:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            # Write to a temporary file and rename, so that readers never see a partial entry
+            fd, tmpname = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as fh:
+                pickle.dump(defmod, fh, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmpname, filename)
+        except (IOError, OSError) as exc:
+            print("Cannot write parse cache entry for %s: %s" % (defmod.name, exc))
+
+
+def default_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'oslib-parser')
+
+
+def parse_file(filename, name=None, inctype='required', cache=None, lazy=None):
+    """
+    Parse a def file.
+
+    @param filename:    The def file to parse
+    @param name:        The name of the module, or None to use the leafname
+    @param inctype:     'required' for modules that outputs are generated for,
+                        'include' for those which are only needed by them
+    @param cache:       ParseCache to use, or None
+    @param lazy:        Whether the SWI statements are only parsed when they are used,
+                        or None to do so for included modules
+
+    @return: DefMod object
+    """
+    if lazy is None:
+        lazy = (inctype == 'include')
+    if name is None:
+        name = os.path.basename(filename).title()
+
+    if cache:
+        key = cache.key(filename, name, lazy=lazy)
+        defmod = cache.load(key)
+        if defmod:
+            defmod.inctype = inctype
+            type_symbols.intern_defmod(defmod)
+            return defmod
+
+    defmod = DefMod(name, modname=name.lower(), inctype=inctype)
+    defmod.lazy = lazy
+    for record in parse_statements(read_def_file(filename), defer_swis=lazy):
+        defmod.add_statement(record)
+
+    type_symbols.intern_defmod(defmod)
+
+    if cache:
+        cache.save(key, defmod)
+
     return defmod
 
 
+def reparse_file(defmod, filename):
+    """
+    Update a module returned by parse_file, for changes to its def file.
+
+    Only the statements whose text has changed are parsed again.
+
+    @param defmod:      The DefMod to update
+    @param filename:    The def file to parse
+
+    @return: number of statements which were parsed
+    """
+    return defmod.reparse(read_def_file(filename))
+
+
 def write_all_swi_conditions(defmods, filename):
-    with open(filename, 'w') as fh:
+    record_dependencies(filename, defmods)
+    with OutputFile(filename) as fh:
         # Header:
         fh.write('''\
 """
@@ -1015,6 +1673,9 @@ def timestamp(epochtime, time_format="%Y-%m-%d %H:%M:%S"):
 def value_repr(value, name, dtype='unknown'):
     if isinstance(value, (tuple, list)):
         value = value[0]
+    if not isinstance(value, int):
+        # Not a number we know, so leave it as it was given
+        return value
     if name.startswith(('Error_', 'Message_')) or name.endswith(('_FileType', '_Class', 'Mask')) or value > 0xffff:
         # These are always formatted as Hex
         return '0x%x' % (value,)
@@ -1049,229 +1710,548 @@ jinja2_functions = {
     }
 
 
-class Templates(object):
+# The input files that each output was generated from, by output filename
+output_dependencies = {}
 
-    def __init__(self, path):
-        import jinja2
-        template_loader = jinja2.FileSystemLoader(searchpath=path)
-        self.environment = jinja2.Environment(loader=template_loader,
-                                              extensions=['jinja2.ext.loopcontrols'])
 
-    def render(self, template_name, template_vars=None):
-        """
-        Render a template, and return it.
+def record_dependencies(output, defmods=None, templates=()):
+    """
+    Record the files which an output was generated from.
 
-        @param: template_name: The name of the template to render
-        @param: template_vars A dictionary of variables to process
+    @param output:      The output filename
+    @param defmods:     The DefMods the output was generated from, or None
+    @param templates:   The template files used to generate the output
+    """
+    inputs = [parser_source()]
+    if defmods:
+        inputs.extend(defmods.filenames)
+    inputs.extend(templates)
+    output_dependencies[output] = inputs
 
-        @return: generated output
-        """
-        if template_vars is None:
-            template_vars = {}
-        temp = self.environment.get_template(template_name)
-        return temp.render(template_vars)
 
-    def render_to_file(self, template_name, output, template_vars=None):
-        """
-        Render a template, and write it to a file.
+def write_depfile(filename, dependencies):
+    """
+    Write a make-style dependency file.
 
-        @param template_name: The name of the template to render
-        @param output:        The output filename
-        @param template_vars: A dictionary of variables to process
-        """
-        jinja2_vars = dict(template_vars)
-        jinja2_vars.update(jinja2_functions)
-        content = self.render(template_name, jinja2_vars)
-        with open(output, 'wb') as f:
-            print("Create %s" % (output,))
-            f.write(content.encode("utf-8"))
+    Each of the inputs is also given an empty rule, so that make does not fail if
+    one is removed.
 
+    @param filename:        The dependency file to write
+    @param dependencies:    Dictionary of output filename to list of input filenames
+    """
+    def escape(name):
+        return name.replace('\\', '\\\\').replace(' ', '\\ ').replace('$', '$$').replace('#', '\\#')
+
+    all_inputs = set()
+    # Not counted as one of the outputs
+    with OutputFile(filename, record=False) as fh:
+        for output, inputs in sorted(dependencies.items()):
+            fh.write('%s:' % (escape(output),))
+            for name in inputs:
+                fh.write(' \\\n    %s' % (escape(name),))
+            fh.write('\n\n')
+            all_inputs.update(inputs)
+        for name in sorted(all_inputs):
+            fh.write('%s:\n' % (escape(name),))
+
+
+# Counts of the outputs which have been written, left unchanged, or removed
+output_stats = {
+        'written': 0,
+        'unchanged': 0,
+        'removed': 0,
+    }
 
-class TypesUsed(object):
 
-    def __init__(self, mod, all_types):
-        self.mod = mod
-        self.all_types = all_types
-        self.reported = {}
-        self.ordered = []
+def file_digest(filename):
+    """
+    Return the SHA-1 hex digest of a file's content, or None if it does not exist.
+    """
+    digest = hashlib.sha1()
+    try:
+        with open(filename, 'rb') as fh:
+            while True:
+                data = fh.read(65536)
+                if not data:
+                    break
+                digest.update(data)
+    except (IOError, OSError):
+        return None
+    return digest.hexdigest()
 
-        # Explicitly declared types from this module
-        for name, dtype in sorted(mod.types.items()):
-            self.use_type(name)
 
-        # Used types in the SWIs
-        for swi, swilist in mod.swis.items():
-            for swidef in swilist:
-                for reg in swidef.entry:
-                    #print("SWI entry type: %r" % (reg.dtype,))
-                    self.use_type(reg.dtype)
-                for reg in swidef.exit:
-                    #print("SWI exit type: %r" % (reg.dtype,))
-                    self.use_type(reg.dtype)
+class OutputFile(object):
+    """
+    Context manager for writing a generated file.
 
-    def __iter__(self):
-        for name in self.ordered:
-            dtype = self.all_types.get(name, None)
-            if isinstance(dtype, TypeRef):
-                dtype = dtype.dtype
-            yield (name, dtype)
+    With atomic writes, the output is written to a temporary file which replaces the
+    output only once it is complete, so that a failure part way through never leaves
+    a partial file behind. If the content is the same as the existing file, that file
+    is left alone, so that its modification time does not change.
 
-    def use_type(self, name):
-        if isinstance(name, str) and name.startswith('&'):
-            name = name[1:]
+    If the output cannot be generated, any previous output is removed, as it can no
+    longer be told apart from one which was generated successfully.
+    """
 
-        if name in self.reported:
-            return
+    def __init__(self, filename, atomic=True, record=True):
+        self.filename = filename
+        self.atomic = atomic
+        self.record = record
+        self.tmpname = None
+        self.fh = None
+        self.digest = hashlib.sha1()
+        self.size = 0
+        # The outcome: 'written', 'unchanged' or 'removed'
+        self.state = None
+
+    def __enter__(self):
+        if self.atomic:
+            fd, self.tmpname = tempfile.mkstemp(dir=os.path.dirname(self.filename) or '.',
+                                                prefix='.' + os.path.basename(self.filename),
+                                                suffix='.tmp')
+            self.fh = io.open(fd, 'w', encoding='utf-8', newline='')
+        else:
+            self.fh = io.open(self.filename, 'w', encoding='utf-8', newline='')
+        return self
 
-        if isinstance(name, str):
-            dtype = self.all_types.get(name, None)
-            if isinstance(dtype, TypeRef):
-                dtype = dtype.dtype
-            #print("Use type %s: %r" % (name, dtype))
-            if not dtype:
-                self.ordered.append(name)
-                self.reported[name] = True
-                return
+    def write(self, data):
+        self.fh.write(data)
+        data = data.encode('utf-8')
+        self.digest.update(data)
+        self.size += len(data)
+
+    def unchanged(self):
+        """
+        Whether the existing output has the same content as that just written.
+        """
+        try:
+            if os.path.getsize(self.filename) != self.size:
+                return False
+        except OSError:
+            return False
+        return file_digest(self.filename) == self.digest.hexdigest()
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.fh.close()
+        if exc_type:
+            if self.tmpname:
+                os.remove(self.tmpname)
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+                self.state = 'removed'
+        elif self.tmpname and self.unchanged():
+            os.remove(self.tmpname)
+            self.state = 'unchanged'
         else:
-            dtype = name
-            name = None
-            #print("Use type %r" % (dtype,))
+            if self.tmpname:
+                # Make the file readable as it would have been had it been created directly
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(self.tmpname, 0o666 & ~umask)
+                if os.path.exists(self.filename) and sys.platform == 'win32':
+                    os.remove(self.filename)
+                os.rename(self.tmpname, self.filename)
+            self.state = 'written'
+
+        if self.state and self.record:
+            output_stats[self.state] += 1
+        return False
+
+
+class Templates(object):
+
+    def __init__(self, path, cache_dir=None):
+        """
+        @param path:        Directory containing the templates
+        @param cache_dir:   Directory to keep the compiled templates in, or None to compile them each time
+        """
+        import jinja2
+        template_loader = jinja2.FileSystemLoader(searchpath=path)
+        bytecode_cache = None
+        if cache_dir and not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # Another process may have created it; otherwise the templates are not cached
+                if not os.path.isdir(cache_dir):
+                    cache_dir = None
+        if cache_dir:
+            bytecode_cache = jinja2.FileSystemBytecodeCache(cache_dir)
+        self.environment = jinja2.Environment(loader=template_loader,
+                                              bytecode_cache=bytecode_cache,
+                                              extensions=['jinja2.ext.loopcontrols'])
+        self._dependencies = {}
+
+    def dependencies(self, template_name):
+        """
+        Return the files that a template is made from, including any it includes or imports.
+
+        @param template_name: The name of the template
+
+        @return: list of template filenames
+        """
+        filenames = self._dependencies.get(template_name)
+        if filenames is None:
+            import jinja2.meta
+            filenames = []
+            pending = [template_name]
+            seen = set()
+            while pending:
+                name = pending.pop(0)
+                if name in seen:
+                    continue
+                seen.add(name)
+                (source, filename, uptodate) = self.environment.loader.get_source(self.environment, name)
+                filenames.append(filename)
+                ast = self.environment.parse(source)
+                # Templates referenced by a computed name are not known, so are skipped
+                pending.extend(ref for ref in jinja2.meta.find_referenced_templates(ast) if ref)
+            self._dependencies[template_name] = filenames
+        return filenames
+
+    def clear_dependencies(self):
+        """
+        Forget the files that the templates are made from, as they may have changed.
+        """
+        self._dependencies = {}
+
+    def load_all(self):
+        """
+        Load and compile all the templates, so that later renders do not need to.
+        """
+        for template_name in self.environment.list_templates():
+            self.environment.get_template(template_name)
+
+    def render(self, template_name, template_vars=None):
+        """
+        Render a template, and return it.
+
+        @param: template_name: The name of the template to render
+        @param: template_vars A dictionary of variables to process
+
+        @return: generated output
+        """
+        if template_vars is None:
+            template_vars = {}
+        temp = self.environment.get_template(template_name)
+        return temp.render(template_vars)
+
+    def render_to_file(self, template_name, output, template_vars=None, atomic=True):
+        """
+        Render a template, and write it to a file.
+
+        The output is streamed to the file as it is generated, rather than being
+        built up in memory.
+
+        @param template_name: The name of the template to render
+        @param output:        The output filename
+        @param template_vars: A dictionary of variables to process
+        @param atomic:        Whether to only replace the output file once it is complete
+        """
+        jinja2_vars = dict(template_vars)
+        jinja2_vars.update(jinja2_functions)
+        record_dependencies(output, jinja2_vars.get('defmods'), self.dependencies(template_name))
+        temp = self.environment.get_template(template_name)
+        with OutputFile(output, atomic=atomic) as fh:
+            for chunk in temp.generate(jinja2_vars):
+                fh.write(chunk)
+        if fh.state == 'unchanged':
+            print("Unchanged %s" % (output,))
+        else:
+            print("Create %s" % (output,))
+
+
+class TypeGraph(object):
+    """
+    The dependencies between the named types and constants of a set of modules.
+
+    The types used by each named type, and the order in which they must be declared,
+    are worked out once and shared by every module which uses them. Types which refer
+    back to themselves (or use such a type), such as Draw_PathElement, have no fixed
+    order, so are walked each time they are used.
+    """
+
+    def __init__(self, all_types, all_constants):
+        self.all_types = all_types
+        self.all_constants = all_constants
+        self._deps = {}             # Named type => named types it uses directly
+        self._order = {}            # Named type => declaration order ending with the type, or None
+        self._constants = {}        # Named type => constants its definition uses
+        self._visiting = set()
+        self.cycles = set()         # Named types which refer back to themselves
+        self._types_used = {}
+        self._constants_used = {}
+
+    def resolve(self, name):
+        dtype = self.all_types.get(name, None)
+        if isinstance(dtype, TypeRef):
+            dtype = dtype.dtype
+        return dtype
+
+    def resolve_constant(self, name):
+        constant = self.all_constants.get(name, None)
+        if isinstance(constant, TypeRef):
+            constant = constant.dtype
+        return constant
+
+    def type_names(self, dtype, names=None):
+        """
+        Find the named types used by a type, without following the names.
+
+        @param dtype:   The type to examine
+        @param names:   List to add the names to, or None to create one
+
+        @return: list of the names, in the order they are used
+        """
+        if names is None:
+            names = []
 
         if isinstance(dtype, str):
-            self.use_type(dtype)
+            if dtype.startswith('&'):
+                dtype = dtype[1:]
+            names.append(dtype)
 
-        elif isinstance(dtype, Struct):
-            # Must include the structure as reported first, in case we have
-            # a self-referential structure.
-            self.reported[name] = True
+        elif isinstance(dtype, (Struct, Union)):
             for field in dtype.members:
-                field_name = field.name
-                field_dtype = field.dtype
-                self.use_type(field_dtype)
+                self.type_names(field.dtype, names)
+
+        elif isinstance(dtype, Array):
+            self.type_names(dtype.dtype, names)
+
+        else:
+            print("Do not understand type '%s' in TypeGraph (%r)" % (dtype.__class__.__name__, dtype))
+
+        return names
+
+    def deps(self, name):
+        """
+        Return the named types used directly by a named type.
+        """
+        deps = self._deps.get(name, None)
+        if deps is None:
+            dtype = self.resolve(name)
+            deps = self.type_names(dtype) if dtype else []
+            self._deps[name] = deps
+        return deps
+
+    def order(self, name):
+        """
+        Return the order in which a named type, and the types it uses, must be declared.
+
+        @return: list of the type names, ending with the type itself, or None if the
+                 type refers back to itself
+        """
+        if name in self._order:
+            return self._order[name]
+
+        if name in self._visiting:
+            self.cycles.add(name)
+            return None
+
+        self._visiting.add(name)
+        order = []
+        seen = set()
+        for dep in self.deps(name):
+            dep_order = self.order(dep)
+            if dep_order is None:
+                order = None
+                break
+            for dep_name in dep_order:
+                if dep_name not in seen:
+                    seen.add(dep_name)
+                    order.append(dep_name)
+        self._visiting.discard(name)
+
+        if order is not None:
+            order.append(name)
+        self._order[name] = order
+        return order
+
+    def walk(self, name, reported, ordered):
+        """
+        Add a named type, and the types it uses, to a declaration order.
+
+        @param name:        The type name
+        @param reported:    Dictionary of the types which are already in the order
+        @param ordered:     List of the type names, in declaration order
+        """
+        if name in reported:
+            return
+
+        order = self.order(name)
+        if order is not None:
+            for dep_name in order:
+                if dep_name not in reported:
+                    reported[dep_name] = True
+                    ordered.append(dep_name)
+            return
+
+        if isinstance(self.resolve(name), Struct):
+            # Must include the structure as reported first, as it refers to itself.
+            reported[name] = True
+        for dep in self.deps(name):
+            self.walk(dep, reported, ordered)
+        ordered.append(name)
+        reported[name] = True
+
+    def constants(self, name):
+        """
+        Return the constants used by the definition of a named type.
+        """
+        constants = self._constants.get(name, None)
+        if constants is None:
+            constants = []
+            dtype = self.resolve(name)
+            if dtype:
+                self._constant_names(dtype, constants)
+            self._constants[name] = constants
+        return constants
 
-        elif isinstance(dtype, Union):
+    def _constant_names(self, dtype, names):
+        if isinstance(dtype, str):
+            if dtype.startswith('&'):
+                dtype = dtype[1:]
+            if isinstance(self.resolve_constant(dtype), Constant):
+                names.append(dtype)
+
+        elif isinstance(dtype, (Struct, Union)):
             for field in dtype.members:
-                field_name = field.name
-                field_dtype = field.dtype
-                self.use_type(field_dtype)
+                self._constant_names(field.dtype, names)
 
         elif isinstance(dtype, Array):
-            self.use_type(dtype.dtype)
+            self._constant_names(dtype.dtype, names)
+            if isinstance(dtype.nelements, str) and not dtype.nelements.isdigit():
+                self._constant_names(dtype.nelements, names)
 
         else:
-            print("Do not understand type '%s' in TypesUsed (%r)" % (dtype.__class__.__name__, dtype))
+            print("Do not understand type '%s' in TypeGraph (%r)" % (dtype.__class__.__name__, dtype))
 
-        if name:
-            self.ordered.append(name)
-            self.reported[name] = True
+    def types_used(self, mod):
+        used = self._types_used.get(mod, None)
+        if used is None:
+            used = TypesUsed(mod, self.all_types, graph=self)
+            self._types_used[mod] = used
+        return used
 
+    def constants_used(self, mod):
+        used = self._constants_used.get(mod, None)
+        if used is None:
+            used = ConstantsUsed(mod, self.all_constants, self.all_types, graph=self)
+            self._constants_used[mod] = used
+        return used
 
-class ConstantsUsed(object):
 
-    def __init__(self, mod, all_constants, all_types):
+class TypesUsed(object):
+
+    def __init__(self, mod, all_types, graph=None):
         self.mod = mod
-        self.all_constants = all_constants
+        self.all_types = all_types
+        self.graph = graph or TypeGraph(all_types, {})
         self.reported = {}
         self.ordered = []
 
         # Explicitly declared types from this module
-        for name, dtype in sorted(mod.constants.items()):
-            self.use_constant(name)
+        for name in sorted(mod.types):
+            self.use_type(name)
 
-        # Used constants in the other things
-        for name, dtype in TypesUsed(mod, all_types):
-            if dtype:
-                self.use_constant(dtype)
+        # Used types in the SWIs
+        for swi, swilist in mod.swis.items():
+            for swidef in swilist:
+                for reg in swidef.entry:
+                    self.use_type(reg.dtype)
+                for reg in swidef.exit:
+                    self.use_type(reg.dtype)
 
     def __iter__(self):
         for name in self.ordered:
-            dtype = self.all_constants.get(name, None)
-            if isinstance(dtype, ConstantRef):
-                dtype = dtype.dtype
-            #print("ConstantEnum: %s: %r" % (name, dtype))
-            yield (name, dtype)
-
-    def use_constant(self, name):
-        if isinstance(name, str) and name.startswith('&'):
-            name = name[1:]
-
-        if name in self.reported:
-            return
+            yield (name, self.graph.resolve(name))
 
+    def use_type(self, name):
         if isinstance(name, str):
-            dtype = self.all_constants.get(name, None)
-            if isinstance(dtype, TypeRef):
-                dtype = dtype.dtype
-            #print("Use constant %s: %r" % (name, dtype))
-            if not dtype:
-                self.reported[name] = True
-                return
+            if name.startswith('&'):
+                name = name[1:]
+            self.graph.walk(name, self.reported, self.ordered)
         else:
-            dtype = name
-            name = None
-            #print("Use constant type %r" % (dtype,))
+            for dep in self.graph.type_names(name):
+                self.graph.walk(dep, self.reported, self.ordered)
 
-        if isinstance(dtype, str):
-            self.use_constant(dtype)
 
-        elif isinstance(dtype, Struct):
-            for field in dtype.members:
-                field_name = field.name
-                field_dtype = field.dtype
-                self.use_constant(field_dtype)
+class ConstantsUsed(object):
 
-        elif isinstance(dtype, Union):
-            for field in dtype.members:
-                field_name = field.name
-                field_dtype = field.dtype
-                self.use_constant(field_dtype)
+    def __init__(self, mod, all_constants, all_types, graph=None):
+        self.mod = mod
+        self.all_constants = all_constants
+        self.graph = graph or TypeGraph(all_types, all_constants)
+        self.reported = {}
+        self.ordered = []
 
-        elif isinstance(dtype, Array):
-            self.use_constant(dtype.dtype)
-            if isinstance(dtype.nelements, str) and not dtype.nelements.isdigit():
-                self.use_constant(dtype.nelements)
+        # Explicitly declared types from this module
+        for name in sorted(mod.constants):
+            self.use_constant(name)
 
-        elif isinstance(dtype, Constant):
-            self.ordered.append(name)
+        # Used constants in the other things
+        for name in self.graph.types_used(mod).ordered:
+            for constant in self.graph.constants(name):
+                self.use_constant(constant)
 
-        else:
-            print("Do not understand type '%s' in ConstantsUsed (%r)" % (dtype.__class__.__name__, dtype))
+    def __iter__(self):
+        for name in self.ordered:
+            yield (name, self.graph.resolve_constant(name))
 
-        if name:
-            self.reported[name] = True
+    def use_constant(self, name):
+        if name in self.reported:
+            return
+        self.reported[name] = True
+        if isinstance(self.graph.resolve_constant(name), Constant):
+            self.ordered.append(name)
 
 
 class LocalTemplates(Templates):
 
-    def __init__(self, path=None):
+    def __init__(self, path=None, cache_dir=None):
         here = os.path.dirname(__file__)
         if path:
             here = os.path.join(here, path)
-        super(LocalTemplates, self).__init__(here)
+        super(LocalTemplates, self).__init__(here, cache_dir=cache_dir)
+
+
+# Where the compiled templates are kept between runs (None to not keep them)
+templates_cache_dir = None
+
+# The templates environment is shared by all the generators within a run
+_local_templates = None
+
+
+def local_templates():
+    global _local_templates
+    if _local_templates is None:
+        _local_templates = LocalTemplates('templates', cache_dir=templates_cache_dir)
+    return _local_templates
 
 
 def create_message_details(defmods, filename):
-    template = LocalTemplates('templates')
+    template = local_templates()
     template.render_to_file('messages.py.j2', filename,
                             {
                                 'defmods': defmods,
+                                'layout': lambda dtype, abi='aarch32': dtype_layout(dtype, defmods, abi),
                             })
 
 
 def create_module_template(defmods, filename, filetype):
-    template = LocalTemplates('templates')
+    template = local_templates()
     template.render_to_file('module-{}.j2'.format(filetype), filename,
                             {
                                 'defmods': defmods,
                                 'types': defmods.types,
-                                'used_types': lambda defmod: TypesUsed(defmod, defmods.types),
-                                'used_constants': lambda defmod: ConstantsUsed(defmod, defmods.constants, defmods.types),
+                                'used_types': defmods.type_graph.types_used,
+                                'used_constants': defmods.type_graph.constants_used,
                                 'dtype_width': lambda dtype: dtype_width(dtype, defmods),
                             })
 
 
 def create_pymodule_template(defmods, filename):
-    template = LocalTemplates('templates')
+    template = local_templates()
     template.render_to_file('pymodule.py.j2', filename,
                             {
                                 'defmods': defmods,
@@ -1279,7 +2259,7 @@ def create_pymodule_template(defmods, filename):
 
 
 def create_api_template(defmods, filename):
-    template = LocalTemplates('templates')
+    template = local_templates()
     template.render_to_file('pyro-api.py.j2', filename,
                             {
                                 'defmods': defmods
@@ -1287,11 +2267,23 @@ def create_api_template(defmods, filename):
 
 
 def create_python_api_template(defmods, filename):
-    template = LocalTemplates('templates')
+    template = local_templates()
     template.render_to_file('python-api.py.j2', filename,
                             {
                                 'defmods': defmods,
                                 'types': defmods.types,
+                                'layout': lambda dtype, abi='aarch32': dtype_layout(dtype, defmods, abi),
+                            })
+
+
+def create_python_struct_api(defmods, filename):
+    template = local_templates()
+    template.render_to_file('python-struct-api.py.j2', filename,
+                            {
+                                'defmods': defmods,
+                                'struct_format': lambda dtype: dtype_struct_format(dtype, defmods),
+                                'member_format': lambda member: member_struct_format(member, defmods),
+                                'register_format': lambda registers: defmods.layout_engine().register_format(registers),
                             })
 
 
@@ -1337,7 +2329,7 @@ def dtype_width(dtype, defmods):
     if isinstance(dtype, tuple):
         dtype = dtype[0]
     if isinstance(dtype, str):
-        dtype = dtype.lower()
+        dtype = type_symbols.lower(dtype)
         #print("dtype: %s" % (dtype,))
 
         while isinstance(dtype, str):
@@ -1358,12 +2350,362 @@ def dtype_width(dtype, defmods):
     return width
 
 
+# Sizes and alignments (in bytes) of the basic types, for each of the ABIs
+layout_abis = {
+        'aarch32': {
+            'pointer': (4, 4),
+            '.int': (4, 4),
+            '.bits': (4, 4),
+            '.bool': (4, 4),
+            '.short': (2, 2),
+            '.byte': (1, 1),
+            '.char': (1, 1),
+            '.string': (1, 1),
+        },
+        'aarch64': {
+            'pointer': (8, 8),
+            '.int': (4, 4),
+            '.bits': (4, 4),
+            '.bool': (4, 4),
+            '.short': (2, 2),
+            '.byte': (1, 1),
+            '.char': (1, 1),
+            '.string': (1, 1),
+        },
+    }
+
+
+# Formats for the struct module of the basic types, for each of the ABIs
+struct_format_abis = {
+        'aarch32': {
+            'pointer': 'I',
+            'word': 'i',
+            'uword': 'I',
+            '.int': 'i',
+            '.bits': 'I',
+            '.bool': 'i',
+            '.short': 'h',
+            '.byte': 'B',
+            '.char': 'c',
+            '.string': 'c',
+        },
+        'aarch64': {
+            'pointer': 'Q',
+            'word': 'q',
+            'uword': 'Q',
+            '.int': 'i',
+            '.bits': 'I',
+            '.bool': 'i',
+            '.short': 'h',
+            '.byte': 'B',
+            '.char': 'c',
+            '.string': 'c',
+        },
+    }
+
+
+class StructFormat(object):
+    """
+    The format of a type for the struct module, and the names of the values it holds.
+    """
+    __slots__ = ('format', 'names')
+
+    def __init__(self, format, names):
+        self.format = format
+        self.names = tuple(names)
+
+    def __repr__(self):
+        return "<{}({!r}, names: {})>".format(self.__class__.__name__,
+                                              self.format,
+                                              self.names)
+
+
+class Layout(object):
+    """
+    The size and alignment of a type, and the offsets of its members.
+    """
+    __slots__ = ('size', 'alignment', 'names', 'offsets')
+
+    def __init__(self, size, alignment, names=(), offsets=()):
+        self.size = size
+        self.alignment = alignment
+        self.names = list(names)
+        self.offsets = list(offsets)
+
+    def __repr__(self):
+        return "<{}(size: {}, alignment: {}, offsets: {})>".format(self.__class__.__name__,
+                                                                  self.size,
+                                                                  self.alignment,
+                                                                  list(zip(self.names, self.offsets)))
+
+    def offset(self, name):
+        return self.offsets[self.names.index(name)]
+
+
+class LayoutEngine(object):
+    """
+    Work out the layout of types in memory, as the C compiler would for an ABI.
+
+    The layouts are kept, so each type is only laid out once.
+    """
+
+    def __init__(self, defmods, abi='aarch32'):
+        self.defmods = defmods
+        self.abi = abi
+        self.basic = layout_abis[abi]
+        self.codes = struct_format_abis[abi]
+        self.layouts = {}
+        self.resolving = set()
+        self.formats = {}
+
+    def layout(self, dtype):
+        """
+        Return the layout of a type.
+
+        @param dtype:   The type name, or Struct, Union or Array object
+
+        @return: Layout object
+        """
+        layout = self.layouts.get(dtype, None)
+        if layout is None:
+            if dtype in self.resolving:
+                layout = LayoutError("Type %r contains itself" % (dtype,))
+            else:
+                self.resolving.add(dtype)
+                try:
+                    layout = self._layout(dtype)
+                except LayoutError as exc:
+                    layout = exc
+                finally:
+                    self.resolving.discard(dtype)
+            self.layouts[dtype] = layout
+
+        if isinstance(layout, LayoutError):
+            raise layout
+        return layout
+
+    def _layout(self, dtype):
+        if isinstance(dtype, str):
+            if dtype.startswith('&'):
+                return Layout(*self.basic['pointer'])
+            name = type_symbols.lower(dtype)
+            if name in self.basic:
+                return Layout(*self.basic[name])
+            resolved = self.defmods.lookup_type(name)
+            if not resolved:
+                raise LayoutError("Cannot determine layout of unknown type %r" % (dtype,))
+            return self.layout(resolved.dtype)
+
+        if isinstance(dtype, Struct):
+            offset = 0
+            alignment = 1
+            offsets = []
+            for member in dtype.members:
+                member_layout = self.layout(member.dtype)
+                offset = self.align(offset, member_layout.alignment)
+                offsets.append(offset)
+                offset += member_layout.size
+                alignment = max(alignment, member_layout.alignment)
+            return Layout(self.align(offset, alignment), alignment,
+                          [member.name for member in dtype.members], offsets)
+
+        if isinstance(dtype, Union):
+            size = 0
+            alignment = 1
+            for member in dtype.members:
+                member_layout = self.layout(member.dtype)
+                size = max(size, member_layout.size)
+                alignment = max(alignment, member_layout.alignment)
+            return Layout(self.align(size, alignment), alignment,
+                          [member.name for member in dtype.members], [0] * len(dtype.members))
+
+        if isinstance(dtype, Array):
+            element_layout = self.layout(dtype.dtype)
+            return Layout(element_layout.size * self.nelements(dtype), element_layout.alignment)
+
+        raise LayoutError("Cannot determine layout of %r" % (dtype,))
+
+    def nelements(self, array):
+        nelements = array.nelements
+        if nelements == '...':
+            # Variable length array at the end of a structure
+            return 0
+        nelements = self.defmods.constant_value(nelements)
+        if not isinstance(nelements, int):
+            raise LayoutError("Cannot determine number of elements in %r" % (array,))
+        return nelements
+
+    @staticmethod
+    def align(offset, alignment):
+        return (offset + alignment - 1) & ~(alignment - 1)
+
+    def basic_type(self, dtype):
+        """
+        Return the basic type that a type name refers to.
+
+        @return: lower case basic type name, 'pointer', or None if it is not a basic type
+        """
+        while isinstance(dtype, str):
+            if dtype.startswith('&'):
+                return 'pointer'
+            name = type_symbols.lower(dtype)
+            if name in self.basic:
+                return name
+            resolved = self.defmods.lookup_type(name)
+            if not resolved:
+                break
+            dtype = resolved.dtype
+        return None
+
+    def struct_format(self, dtype):
+        """
+        Return the format of a type for the struct module.
+
+        The format does not include the byte order, and any padding is included
+        explicitly. Unions are given as bytes, as the struct module cannot overlay
+        values.
+
+        @param dtype:   The type name, or Struct, Union or Array object
+
+        @return: StructFormat object
+        """
+        fmt = self.formats.get(dtype, None)
+        if fmt is None:
+            fmt = self._struct_format(dtype)
+            self.formats[dtype] = fmt
+        return fmt
+
+    def _struct_format(self, dtype):
+        layout = self.layout(dtype)
+
+        if isinstance(dtype, str):
+            basic = self.basic_type(dtype)
+            if basic:
+                return StructFormat(self.codes[basic], [''])
+            return self.struct_format(self.defmods.lookup_type(dtype).dtype)
+
+        if isinstance(dtype, Struct):
+            formats = []
+            names = []
+            end = 0
+            for member, offset in zip(dtype.members, layout.offsets):
+                if offset > end:
+                    formats.append('%ix' % (offset - end,))
+                member_format = self.struct_format(member.dtype)
+                formats.append(member_format.format)
+                names.extend(self.join_names(member.name, member_format.names))
+                end = offset + self.layout(member.dtype).size
+            if layout.size > end:
+                formats.append('%ix' % (layout.size - end,))
+            return StructFormat(''.join(formats), names)
+
+        if isinstance(dtype, Union):
+            return StructFormat('%is' % (layout.size,), [''])
+
+        # Must be an Array, as the layout has been determined
+        nelements = self.nelements(dtype)
+        element_format = self.struct_format(dtype.dtype)
+        if element_format.format == 'c':
+            return StructFormat('%is' % (nelements,), [''])
+        if len(element_format.format) == 1:
+            return StructFormat('%i%s' % (nelements, element_format.format),
+                                ['[%i]' % (index,) for index in range(nelements)])
+        names = []
+        for index in range(nelements):
+            names.extend(self.join_names('[%i]' % (index,), element_format.names))
+        return StructFormat(element_format.format * nelements, names)
+
+    def member_format(self, member):
+        """
+        Return the format of a structure or union member for the struct module.
+
+        @param member:  Member object
+
+        @return: StructFormat object, with the values named within the member
+        """
+        member_format = self.struct_format(member.dtype)
+        return StructFormat(member_format.format, self.join_names(member.name, member_format.names))
+
+    @staticmethod
+    def join_names(prefix, names):
+        return [prefix + ('.' + name if name and name[0] != '[' else name) for name in names]
+
+    def register_format(self, registers):
+        """
+        Return the format of a block of registers for the struct module.
+
+        Registers which are not named, are constant (including those given a constant's
+        value) or are corrupted are left as padding.
+
+        @param registers:   List of Register objects, from the entry or exit of a SWI
+
+        @return: StructFormat object
+        """
+        used = {}
+        for reg in registers:
+            if reg.reg[0] != 'R' or not reg.name or reg.assign in ('#', '?') or reg.dtype == '.literal':
+                continue
+            number = int(reg.reg[1:])
+            if number in used:
+                continue
+            if reg.assign == '->':
+                code = self.codes['pointer']
+            elif self.basic_type(reg.dtype) in ('.int', '.short', '.bool'):
+                code = self.codes['word']
+            else:
+                code = self.codes['uword']
+            used[number] = (code, reg.name)
+
+        word = self.basic['pointer'][0]
+        formats = []
+        names = []
+        padding = 0
+        for number in range(max(used) + 1 if used else 0):
+            if number not in used:
+                padding += word
+                continue
+            if padding:
+                formats.append('%ix' % (padding,))
+                padding = 0
+            (code, name) = used[number]
+            formats.append(code)
+            names.append(name)
+        return StructFormat(''.join(formats), names)
+
+
+def dtype_layout(dtype, defmods, abi='aarch32'):
+    """
+    Return the layout of a given type, or None if it cannot be determined.
+    """
+    try:
+        return defmods.layout_engine(abi).layout(dtype)
+    except LayoutError:
+        return None
+
+
+def dtype_struct_format(dtype, defmods, abi='aarch32'):
+    """
+    Return the struct module format of a given type, or None if it cannot be determined.
+    """
+    try:
+        return defmods.layout_engine(abi).struct_format(dtype)
+    except LayoutError:
+        return None
+
+
+def member_struct_format(member, defmods, abi='aarch32'):
+    """
+    Return the struct module format of a member, or None if it cannot be determined.
+    """
+    try:
+        return defmods.layout_engine(abi).member_format(member)
+    except LayoutError:
+        return None
+
+
 def create_aarch64_api(defmods, filename):
     def simple_orr_constant(defmod, value):
-        if value in defmod.constants:
-            value = defmod.constants[value].value
-        if isinstance(value, list):
-            value = value[0]
+        value = defmods.constant_value(value, value)
         if not isinstance(value, int):
             print("WARNING: Value %r (%s) is not a number" % (value, value.__class__.__name__))
             return True
@@ -1379,19 +2721,20 @@ def create_aarch64_api(defmods, filename):
             return False
         return True
 
-    template = LocalTemplates('templates')
+    template = local_templates()
     template.render_to_file('aarch64-api.s.j2', filename,
                             {
                                 'defmods': defmods,
                                 'types': defmods.types,
                                 'simple_orr_constant': simple_orr_constant,
+                                'constant_value': defmods.constant_value,
                                 'oslib_swifunc': oslib_swifunc,
                                 'dtype_width': lambda dtype: dtype_width(dtype, defmods),
                             })
 
 
 def create_pymodule_constants(defmods, filename):
-    template = LocalTemplates('templates')
+    template = local_templates()
     template.render_to_file('pymodule_constants.py.j2', filename,
                             {
                                 'defmods': defmods
@@ -1404,7 +2747,7 @@ def create_nvram_constants(defmods, filename):
             'RISCIX',
             'RISCIX32',
         }
-    template = LocalTemplates('templates')
+    template = local_templates()
     # Rather than making the template do all the work, we'll filter the values down to
     # just the constants, so that they can go into the file more easily.
     values = {}
@@ -1432,10 +2775,7 @@ def create_nvram_constants(defmods, filename):
                 # Skip the names that we don't care about.
                 continue
 
-            value = constant.value
-            if isinstance(value, (list, tuple)):
-                # Annotated value
-                value = value[0]
+            value = defmods.constant_value(constant.value, constant.value)
 
             if name in names:
                 print("Warning: Name {} is defined multiple times".format(name))
@@ -1455,10 +2795,991 @@ def create_nvram_constants(defmods, filename):
                             })
 
 
-class TypeRef(object):
+def create_module_cmhg_template(defmods, filename):
+    create_module_template(defmods, filename, 'cmhg')
+
+
+def create_module_c_template(defmods, filename):
+    create_module_template(defmods, filename, 'c')
+
+
+def create_module_h_template(defmods, filename):
+    create_module_template(defmods, filename, 'h')
+
+
+# Files which aren't really modules, and so cannot have C module templates generated
+cmodule_skip_re = re.compile(r'/OS[^/]*\.swi'
+                             r'|/Wimp[^/][^/]*\.swi'   # Any of the sub-files for the Wimp
+                             r'|/Toolbox/')             # No need to rebuild the Toolbox modules
+# Failing modules at the moment:
+#   ConvertSprite (reuse of the variable 'regs')
+#   DiagnosticDump (reuse of the variable 'regs')
+#   DrawFile (Draw_PathElement is referenced within Draw_PathElement)
+#   FileSwitch (wrong CMHG SWI chunk base)
+#   ImageFileConvert (misinterpreted Void type)
+#   ImageFileRender (misinterpreted .int type)
+#   InverseTable (misinterpreted OSSpriteOp_Area type - should be .Ref?)
+#   PDriver (misinterpreted .int type, Draw_PathElement referenced within Draw_PathElement)
+#   ZapFontMenu (wrong CMHG SWI chunk base)
+
+
+def cmodule_wanted(filename):
+    return not cmodule_skip_re.search(filename.replace(os.sep, '/'))
+
+
+# Generators which can be used in batch mode:
+#   name: (function, default output pattern, resolve needs from the file's own tree, file filter)
+# The output pattern is relative to the output directory, and '{name}' is replaced by the
+# name of the def file.
+batch_generators = {
+        'pymodule-template': (create_pymodule_template, 'pymodule-templates/{name}.py', False, None),
+        'pymodule-constants': (create_pymodule_constants, 'pymodule-constants/{name}.py', False, None),
+        'api-template': (create_api_template, 'pyromaniac-apis/{name}.py', False, None),
+        'python-api-template': (create_python_api_template, 'python-apis/{name}.py', False, None),
+        'python-struct-api': (create_python_struct_api, 'python-struct-apis/{name}.py', False, None),
+        'aarch64-api': (create_aarch64_api, 'aarch64/{name}.s', False, None),
+        'module-cmhg-template': (create_module_cmhg_template, 'cmodule-templates/{name}/cmhg/modhead', True, cmodule_wanted),
+        'module-c-template': (create_module_c_template, 'cmodule-templates/{name}/c/module', True, cmodule_wanted),
+        'module-h-template': (create_module_h_template, 'cmodule-templates/{name}/h/types', True, cmodule_wanted),
+    }
+
+
+class BuildManifest(object):
+    """
+    Record of the inputs that each batch output was generated from.
+
+    Outputs whose inputs (def files, templates and the parser itself) have not changed
+    since they were generated, and which have not themselves been changed, do not need
+    to be generated again, and so their def files need not even be parsed.
+    """
+    version = 1
+
+    def __init__(self, filename, load=True):
+        self.filename = filename
+        self.outputs = {}
+        self._digests = {}
+        if load:
+            self.load()
+
+    def __repr__(self):
+        return "<{}({!r}, {} outputs)>".format(self.__class__.__name__,
+                                              self.filename, len(self.outputs))
+
+    def load(self):
+        try:
+            with io.open(self.filename, 'r', encoding='utf-8') as fh:
+                data = json.load(fh)
+        except (IOError, OSError, ValueError):
+            # No usable manifest, so everything will be generated
+            return
+        if data.get('version') == self.version:
+            self.outputs = data.get('outputs', {})
+
+    def save(self):
+        data = {
+                'version': self.version,
+                'outputs': self.outputs,
+            }
+        dirname = os.path.dirname(self.filename)
+        if dirname and not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # Another process may have created it
+                if not os.path.isdir(dirname):
+                    raise
+        with OutputFile(self.filename, record=False) as fh:
+            fh.write(json.dumps(data, indent=1, sort_keys=True))
+
+    def digest(self, filename):
+        """
+        Return the digest of an input file, which is only read once in each run.
+        """
+        if filename not in self._digests:
+            self._digests[filename] = file_digest(filename)
+        return self._digests[filename]
+
+    def up_to_date(self, output, generator, basedir):
+        """
+        Whether an output was generated from the same inputs as it would be now.
+        """
+        entry = self.outputs.get(output)
+        if not entry or entry['generator'] != generator or entry['basedir'] != basedir:
+            return False
+        for filename, digest in entry['inputs'].items():
+            if self.digest(filename) != digest:
+                return False
+        return file_digest(output) == entry['output']
+
+    def record(self, output, generator, basedir, inputs):
+        self.outputs[output] = {
+                'generator': generator,
+                'basedir': basedir,
+                'inputs': dict((filename, self.digest(filename)) for filename in inputs),
+                'output': file_digest(output),
+            }
+
+    def forget(self, output):
+        self.outputs.pop(output, None)
+
+
+def plan_batch(files, output_dir, generators=None, patterns=None, oslib_dir=None):
+    """
+    Work out the per-module outputs for many def files.
+
+    @param files:       List of def files to generate outputs for
+    @param output_dir:  Directory to write the outputs to
+    @param generators:  List of the batch_generators names to use, or None for all
+    @param patterns:    Dictionary of generator name to output pattern, to override the defaults
+    @param oslib_dir:   OSLib directory to resolve needs from, or None to use the file's own tree
+                        for the generators which need it
+
+    @yield: tuple of (def file, name, generator name, function, basedir, output filename)
+    """
+    if generators is None:
+        generators = sorted(batch_generators)
+    patterns = patterns or {}
+
+    for defmodfile in files:
+        name = os.path.basename(defmodfile)
+        if name.endswith('.swi'):
+            name = name[:-4]
+
+        for generator in generators:
+            (func, pattern, needs, wanted) = batch_generators[generator]
+            if wanted and not wanted(defmodfile):
+                continue
+
+            basedir = oslib_dir
+            if needs and not basedir:
+                basedir = os.path.dirname(os.path.dirname(os.path.dirname(defmodfile)))
+            output = os.path.join(output_dir, patterns.get(generator, pattern).format(name=name))
+            yield (defmodfile, name, generator, func, basedir, output)
+
+
+def default_manifest_file(cache, output_dir):
+    """
+    Return the manifest file to use for an output directory.
+
+    The manifest is kept with the parse cache, rather than in the output directory, so
+    that it is not distributed with the outputs.
+
+    @param cache:       ParseCache in use, or None
+    @param output_dir:  Directory the outputs are written to
+
+    @return: manifest filename, or None if there is no cache to keep it in
+    """
+    if not cache:
+        return None
+    key = hashlib.sha1(os.path.abspath(output_dir).encode('utf-8')).hexdigest()
+    return os.path.join(cache.path, 'manifests', key + '.json')
+
+
+def generate_batch(files, output_dir, generators=None, patterns=None, oslib_dir=None, cache=None,
+                   jobs=1, manifest=None, parsed=None):
+    """
+    Generate the per-module outputs for many def files in a single run.
+
+    Each def file is parsed only once, and the parsed modules are shared between the
+    DefMods for each of the files which need them.
+
+    @param files:       List of def files to generate outputs for
+    @param output_dir:  Directory to write the outputs to
+    @param generators:  List of the batch_generators names to use, or None for all
+    @param patterns:    Dictionary of generator name to output pattern, to override the defaults
+    @param oslib_dir:   OSLib directory to resolve needs from, or None to use the file's own tree
+                        for the generators which need it
+    @param cache:       ParseCache to use, or None
+    @param jobs:        Number of processes to use, or None for the number of CPUs
+    @param manifest:    BuildManifest to skip unchanged outputs with, and update, or None
+    @param parsed:      Dictionary to keep the parsed modules in, by absolute filename, or None
+
+    @return: number of outputs which could not be generated
+    """
+    # Decide which outputs need to be generated, before anything is parsed
+    planned = []
+    for plan in plan_batch(files, output_dir, generators=generators, patterns=patterns,
+                           oslib_dir=oslib_dir):
+        (defmodfile, name, generator, func, basedir, output) = plan
+        if manifest and manifest.up_to_date(output, generator, basedir):
+            print("Unchanged %s" % (output,))
+            output_stats['unchanged'] += 1
+            # Still a dependency of the output, for the depfile
+            output_dependencies[output] = sorted(manifest.outputs[output]['inputs'])
+            continue
+        planned.append(plan)
+
+    if parsed is None:
+        parsed = {}
+    if jobs != 1 and planned:
+        # Parse everything we might need up front, in parallel
+        filenames = []
+        basedirs = set()
+        for (defmodfile, name, generator, func, basedir, output) in planned:
+            filenames.append(defmodfile)
+            if basedir:
+                basedirs.add(basedir)
+        for basedir in sorted(basedirs):
+            defmods = DefMods(basedir=basedir)
+            defmods._collect()
+            filenames.extend(sorted(defmods.found_defmods.values()))
+        parsed.update(parse_files_parallel(filenames, jobs=jobs, cache=cache, exclude=parsed))
+
+    # Build the module sets for every output, before any are rendered
+    batch_jobs = []
+    failed = 0
+    # The module sets, keyed by the file and the directory needs are resolved from
+    file_defmods = {}
+    for (defmodfile, name, generator, func, basedir, output) in planned:
+        if (defmodfile, basedir) not in file_defmods:
+            if not any(key[0] == defmodfile for key in file_defmods):
+                print("+++ Processing %s from %s" % (name, defmodfile))
+            defmods = DefMods(basedir=basedir, cache=cache, parsed=parsed)
+            try:
+                defmods.add(defmodfile)
+            except ParseError as exc:
+                print("Failed to parse %s: %s" % (defmodfile, exc))
+                failed += 1
+                defmods = None
+            file_defmods[(defmodfile, basedir)] = defmods
+        defmods = file_defmods[(defmodfile, basedir)]
+        if not defmods:
+            if manifest:
+                manifest.forget(output)
+            continue
+
+        dirname = os.path.dirname(output)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        batch_jobs.append((generator, name, func, defmods, output))
+
+    failed_outputs = run_batch_jobs(batch_jobs, jobs=jobs)
+    failed += len(failed_outputs)
+
+    if manifest:
+        for (defmodfile, name, generator, func, basedir, output) in planned:
+            if output in failed_outputs or output not in output_dependencies:
+                manifest.forget(output)
+            else:
+                manifest.record(output, generator, basedir, output_dependencies[output])
+        manifest.save()
+
+    return failed
+
+
+# The jobs being run by run_batch_jobs, which are set before the workers are forked
+_batch_jobs = []
+
+
+def _batch_job_worker(index):
+    (generator, name, func, defmods, output) = _batch_jobs[index]
+    # The output_stats may be in a worker process, so we return our changes to them
+    before = dict(output_stats)
+    error = None
+    try:
+        func(defmods, output)
+    except Exception as exc:
+        error = "%s: %s" % (exc.__class__.__name__, exc)
+    stats = dict((state, count - before[state]) for state, count in output_stats.items())
+    return (error, stats, output_dependencies.get(output))
+
+
+def run_batch_jobs(batch_jobs, jobs=1):
+    """
+    Render the outputs for batch mode, reporting any that fail.
+
+    When multiple jobs are used, the worker processes are forked from this one, so
+    they share the parsed modules without them being copied.
+
+    @param batch_jobs:  List of tuples of (generator, name, function, defmods, output)
+    @param jobs:        Number of processes to use, or None for the number of CPUs
+
+    @return: set of the outputs which failed
+    """
+    global _batch_jobs
+
+    context = None
+    if jobs != 1 and len(batch_jobs) > 1:
+        import multiprocessing
+        try:
+            context = multiprocessing.get_context('fork')
+        except ValueError:
+            # Fork isn't available on this platform, so render them here
+            pass
+
+    # Compile the templates once, so that every worker has them
+    local_templates().load_all()
+
+    _batch_jobs = batch_jobs
+    try:
+        if context:
+            pool = context.Pool(jobs)
+            results = pool.imap(_batch_job_worker, range(len(batch_jobs)))
+        else:
+            pool = None
+            results = (_batch_job_worker(index) for index in range(len(batch_jobs)))
+
+        failed = set()
+        for (generator, name, func, defmods, output), (error, stats, inputs) in zip(batch_jobs, results):
+            if error:
+                print("Failed to generate %s for %s: %s" % (generator, name, error))
+                failed.add(output)
+            if pool:
+                for state, count in stats.items():
+                    output_stats[state] += count
+                if inputs:
+                    output_dependencies[output] = inputs
+
+        if pool:
+            pool.close()
+            pool.join()
+    finally:
+        _batch_jobs = []
+
+    return failed
+
+
+def _parse_file_worker(filename, cache):
+    try:
+        # The SWIs are parsed here too, as that is most of the work
+        return parse_file(filename, inctype='include', cache=cache, lazy=False)
+    except ParseError:
+        # Reported when the file is parsed again by DefMods.add
+        return None
+
+
+def parse_files_parallel(filenames, jobs=None, cache=None, exclude=()):
+    """
+    Parse a number of def files across multiple processes.
+
+    Files which fail to parse are omitted, so that the failure will be reported
+    when they are parsed again serially.
+
+    @param filenames:   List of the def files to parse
+    @param jobs:        Number of processes to use, or None for the number of CPUs
+    @param cache:       ParseCache to use, or None
+    @param exclude:     Filenames (as absolute paths) which do not need to be parsed
+
+    @return: dictionary of absolute filename to the parsed DefMod
+    """
+    import concurrent.futures
+
+    keys = {}
+    for filename in filenames:
+        key = os.path.abspath(filename)
+        if key not in exclude and key not in keys:
+            keys[key] = filename
+
+    parsed = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = dict((executor.submit(_parse_file_worker, filename, cache), key)
+                       for key, filename in keys.items())
+        for future in concurrent.futures.as_completed(futures):
+            defmod = future.result()
+            if defmod:
+                # Share the types with everything parsed in this process
+                type_symbols.intern_defmod(defmod)
+                parsed[futures[future]] = defmod
+    return parsed
+
+
+def file_stamp(filename):
+    """
+    Return a value which changes when a file is modified, or None if it does not exist.
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+
+class Watcher(object):
+    """
+    Regenerates outputs when the def files or templates that they were generated from change.
+
+    The parsed modules are kept between changes. A changed def file is reparsed in place,
+    and only the outputs which were generated from it, either directly or through the
+    Needs of their modules, are generated again. The input files are polled, rather than
+    relying on any platform's change notifications.
+    """
+
+    def __init__(self, parsed=None, cache=None, interval=1.0):
+        """
+        @param parsed:      Dictionary of the parsed modules, by absolute filename, to keep
+                            up to date, or None
+        @param cache:       ParseCache to use for modules which have not been parsed, or None
+        @param interval:    Time between polls of the input files, in seconds
+        """
+        self.parsed = {} if parsed is None else parsed
+        self.cache = cache
+        self.interval = interval
+        self.outputs = {}       # Output filename => (module set key, function)
+        self.inputs = {}        # Output filename => input filenames
+        self.dependents = {}    # Input filename => output filenames generated from it
+        self.module_sets = {}   # (def files, basedir) => DefMods, built when they are needed
+        self.stamps = {}        # Input filename => file_stamp when last checked
+
+        # Changes to the parser itself cannot be picked up without restarting
+        self.source = os.path.abspath(parser_source())
+
+    def __repr__(self):
+        return "<{}({} outputs, {} inputs)>".format(self.__class__.__name__,
+                                                   len(self.outputs), len(self.stamps))
+
+    def add_output(self, output, files, basedir, func, defmods=None, inputs=None):
+        """
+        Add an output to be regenerated when its inputs change.
+
+        @param output:  The output filename
+        @param files:   List of the def files the output is generated from
+        @param basedir: OSLib directory to resolve needs from, or None
+        @param func:    Function to generate the output, called as func(defmods, output)
+        @param defmods: DefMods which the output was generated from, or None to create it
+                        when it is needed
+        @param inputs:  List of the files the output was generated from, or None if not
+                        known, in which case the def files are used
+        """
+        key = (tuple(files), basedir)
+        self.outputs[output] = (key, func)
+        if defmods is not None:
+            self.module_sets[key] = defmods
+        self.set_inputs(output, inputs or files)
+
+    def set_inputs(self, output, inputs):
+        for filename in self.inputs.get(output, ()):
+            self.dependents[filename].discard(output)
+
+        inputs = [os.path.abspath(filename) for filename in inputs]
+        inputs = [filename for filename in inputs if filename != self.source]
+        self.inputs[output] = inputs
+        for filename in inputs:
+            self.dependents.setdefault(filename, set()).add(output)
+            if filename not in self.stamps:
+                self.stamps[filename] = file_stamp(filename)
+
+    def changed_files(self):
+        """
+        Return the input files which have changed since they were last checked.
+        """
+        changed = []
+        for filename, stamp in self.stamps.items():
+            new_stamp = file_stamp(filename)
+            if new_stamp != stamp:
+                self.stamps[filename] = new_stamp
+                changed.append(filename)
+        return sorted(changed)
+
+    def module_set(self, key):
+        """
+        Return the DefMods for a set of def files, creating it from the parsed modules if needed.
+
+        @return: DefMods, or None if the modules could not be parsed
+        """
+        defmods = self.module_sets.get(key)
+        if defmods is None:
+            (files, basedir) = key
+            defmods = DefMods(basedir=basedir, cache=self.cache, parsed=self.parsed)
+            try:
+                for defmodfile in files:
+                    defmods.add(defmodfile)
+            except ParseError as exc:
+                print("Failed to parse %s: %s" % (', '.join(files), exc))
+                return None
+            self.module_sets[key] = defmods
+        return defmods
+
+    def refresh(self, changed):
+        """
+        Bring the parsed modules up to date with changed input files.
+
+        Modules which can no longer be parsed are forgotten, so that they are parsed
+        again when they are next used.
+
+        @param changed: List of the input filenames which have changed
+
+        @return: set of the def files which could not be parsed
+        """
+        failed = set()
+        for filename in changed:
+            defmod = self.parsed.get(filename)
+            if defmod is not None:
+                if os.path.isfile(filename):
+                    try:
+                        reparse_file(defmod, filename)
+                    except ParseError as exc:
+                        print("Failed to parse %s: %s" % (filename, exc))
+                        failed.add(filename)
+                        del self.parsed[filename]
+                else:
+                    del self.parsed[filename]
+
+                # The indexes of the module sets which use the module are out of date
+                for key, defmods in list(self.module_sets.items()):
+                    if any(os.path.abspath(name) == filename for name in defmods.filenames):
+                        del self.module_sets[key]
+            else:
+                # Templates may include different templates now
+                local_templates().clear_dependencies()
+        return failed
+
+    def update(self, changed):
+        """
+        Regenerate the outputs affected by changed input files.
+
+        @param changed: List of the input filenames which have changed
+        """
+        start = time.time()
+
+        outputs = set()
+        for filename in changed:
+            outputs.update(self.dependents.get(filename, ()))
+        failed = set()
+        for filename in self.refresh(changed):
+            failed.update(self.dependents.get(filename, ()))
+
+        generated = 0
+        for output in sorted(outputs - failed):
+            (key, func) = self.outputs[output]
+            defmods = self.module_set(key)
+            if defmods is None:
+                continue
+            try:
+                func(defmods, output)
+            except Exception as exc:
+                print("Failed to generate %s: %s: %s" % (output, exc.__class__.__name__, exc))
+                continue
+            generated += 1
+            self.set_inputs(output, output_dependencies.get(output) or key[0])
+
+        print("Regenerated %i of %i outputs for changes to %s in %.1f ms"
+              % (generated, len(outputs), ', '.join(os.path.basename(filename) for filename in changed),
+                 (time.time() - start) * 1000))
+
+    def run(self):
+        """
+        Watch the inputs for changes until interrupted.
+        """
+        print("Watching %i files for changes to %i outputs" % (len(self.stamps), len(self.outputs)))
+        try:
+            while True:
+                time.sleep(self.interval)
+                changed = self.changed_files()
+                if changed:
+                    self.update(changed)
+        except KeyboardInterrupt:
+            pass
+
+
+class GenerationServer(Watcher):
+    """
+    Generates outputs for clients which connect to a Unix domain socket.
+
+    The def files are parsed, and the templates compiled, when the server starts, and
+    are kept between requests. Before each request is handled, the files are checked
+    for changes in the same way as in watch mode.
+
+    Each request and response is a single line of JSON. A request is either:
+        {"files": [<def files or module names>], "generate": [[<generator>, <output>], ...]}
+    where the generator is a batch generator name or an output option (such as
+    'create-python-api-template'), or:
+        {"files": [<def files>], "output_dir": <directory>, "generators": [<generator>, ...]}
+    with the same parameters as batch mode. Either may also give "oslib_dir" and "depfile".
+    The response is {"status": <exit status>, "output": <messages>}.
+    """
+
+    def __init__(self, path, basedir=None, cache=None, jobs=1, timeout=10.0):
+        """
+        @param path:    Filename of the socket to listen on
+        @param basedir: OSLib directory to load the modules from and resolve needs from
+        @param cache:   ParseCache to use, or None
+        @param jobs:    Number of processes to parse the modules with
+        @param timeout: Time to wait for a client to send its request, in seconds
+        """
+        super(GenerationServer, self).__init__(cache=cache)
+        self.path = path
+        self.basedir = basedir
+        self.jobs = jobs
+        self.timeout = timeout
+        self._resolvers = {}
+
+    def check_socket(self):
+        """
+        Make sure that the socket can be created, removing one left behind by a server
+        which is no longer running.
+
+        @raise ServerError: if the path is in use
+        """
+        import errno
+        import socket
+
+        try:
+            mode = os.stat(self.path).st_mode
+        except OSError:
+            # Nothing there
+            return
+        if not stat.S_ISSOCK(mode):
+            raise ServerError("%s exists, and is not a socket" % (self.path,))
+
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.path)
+        except (IOError, OSError) as exc:
+            if exc.errno != errno.ECONNREFUSED:
+                raise ServerError("Cannot check the socket %s: %s" % (self.path, exc))
+            # Nothing is listening, so it was left behind
+            os.unlink(self.path)
+            return
+        finally:
+            probe.close()
+        raise ServerError("A server is already running on %s" % (self.path,))
+
+    def load(self):
+        """
+        Parse the modules in the OSLib directory, and compile the templates.
+        """
+        if self.basedir:
+            defmods = DefMods(basedir=self.basedir, cache=self.cache, parsed=self.parsed)
+            if self.jobs != 1:
+                defmods.parse_all(jobs=self.jobs)
+            else:
+                defmods._collect()
+                for filename in sorted(defmods.found_defmods.values()):
+                    key = os.path.abspath(filename)
+                    if key in self.parsed:
+                        continue
+                    try:
+                        self.parsed[key] = parse_file(filename, inctype='include', cache=self.cache)
+                    except ParseError:
+                        # Reported when a request needs the module
+                        pass
+        templates = local_templates()
+        templates.load_all()
+        for template_name in templates.environment.list_templates():
+            for filename in templates.dependencies(template_name):
+                self.stamps[os.path.abspath(filename)] = file_stamp(filename)
+        self.stamp_parsed()
+
+    def stamp_parsed(self):
+        """
+        Start checking for changes to any modules which have been parsed since the last check.
+        """
+        for filename in self.parsed:
+            if filename not in self.stamps:
+                self.stamps[filename] = file_stamp(filename)
+
+    def resolve(self, name, basedir):
+        """
+        Return the def file for a module name, or the name if it is already a file.
+        """
+        if os.path.isfile(name):
+            return name
+        resolver = self._resolvers.get(basedir)
+        if resolver is None:
+            resolver = DefMods(basedir=basedir)
+            self._resolvers[basedir] = resolver
+        return resolver.resolve(name.lower()) or name
+
+    def handle(self, request):
+        """
+        Generate the outputs for a request.
+
+        @param request: Dictionary of the request parameters
+
+        @return: exit status
+        """
+        changed = self.changed_files()
+        if changed:
+            self.refresh(changed)
+
+        for state in output_stats:
+            output_stats[state] = 0
+        output_dependencies.clear()
+
+        basedir = request.get('oslib_dir') or self.basedir
+        failed = 0
+        if request.get('output_dir'):
+            manifest = None
+            manifest_file = request.get('manifest') or default_manifest_file(self.cache,
+                                                                             request['output_dir'])
+            if manifest_file:
+                manifest = BuildManifest(manifest_file, load=not request.get('force'))
+            failed = generate_batch(request.get('files', []), request['output_dir'],
+                                    generators=request.get('generators'),
+                                    patterns=request.get('patterns'),
+                                    oslib_dir=request.get('oslib_dir'), cache=self.cache,
+                                    manifest=manifest, parsed=self.parsed)
+        else:
+            files = [self.resolve(name, basedir) for name in request.get('files', [])]
+            defmods = self.module_set((tuple(files), basedir))
+            if defmods is None:
+                return 1
+            for generator, output in request.get('generate', []):
+                func = find_generator(generator)
+                if not func:
+                    print("Generator '%s' is not known" % (generator,))
+                    failed += 1
+                    continue
+                try:
+                    func(defmods, output)
+                except Exception as exc:
+                    print("Failed to generate %s: %s: %s" % (output, exc.__class__.__name__, exc))
+                    failed += 1
+
+        self.stamp_parsed()
+        if request.get('depfile'):
+            write_depfile(request['depfile'], output_dependencies)
+        report_output_stats()
+        if failed:
+            print("%i failures whilst generating outputs" % (failed,))
+            return 1
+        return 0
+
+    def handle_connection(self, connection):
+        """
+        Read a request from a client, and send the response.
+
+        Anything printed whilst the request is handled is returned to the client.
+        """
+        # A client which never sends its request must not hold up the others
+        connection.settimeout(self.timeout)
+        fh = connection.makefile('rb')
+        try:
+            line = fh.readline()
+        finally:
+            fh.close()
+        if not line:
+            return
+
+        # Python 2 prints byte strings
+        messages = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+        stdout = sys.stdout
+        sys.stdout = messages
+        try:
+            request = json.loads(line.decode('utf-8'))
+            status = self.handle(request)
+        except Exception as exc:
+            print("Failed to handle request: %s: %s" % (exc.__class__.__name__, exc))
+            status = 1
+        finally:
+            sys.stdout = stdout
+
+        response = {
+                'status': status,
+                'output': messages.getvalue(),
+            }
+        connection.sendall((json.dumps(response) + '\n').encode('utf-8'))
+
+    def serve(self):
+        """
+        Handle requests until interrupted.
+        """
+        import signal
+        import socket
+
+        def terminate(signum, frame):
+            raise KeyboardInterrupt()
+
+        # Remove the socket when the server is killed, as well as when it is interrupted
+        signal.signal(signal.SIGTERM, terminate)
+
+        self.check_socket()
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        listener.listen(5)
+        print("Serving %i modules on %s" % (len(self.parsed), self.path))
+        try:
+            while True:
+                (connection, _) = listener.accept()
+                try:
+                    start = time.time()
+                    self.handle_connection(connection)
+                    if debug:
+                        print("Request handled in %.1f ms" % ((time.time() - start) * 1000,))
+                except (IOError, OSError) as exc:
+                    print("Request failed: %s" % (exc,))
+                finally:
+                    connection.close()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            listener.close()
+            os.unlink(self.path)
+
+
+def send_request(path, request):
+    """
+    Send a request to a GenerationServer, and return its response.
+
+    @param path:    Filename of the server's socket
+    @param request: Dictionary of the request parameters
+
+    @return: dictionary of the response
+    """
+    import socket
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+        connection.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        fh = connection.makefile('rb')
+        try:
+            line = fh.readline()
+        finally:
+            fh.close()
+    finally:
+        connection.close()
+    if not line:
+        raise IOError("No response from the server on %s" % (path,))
+    return json.loads(line.decode('utf-8'))
+
+
+# The bit set in the X form of a SWI number, which returns errors rather than raising them
+SWI_X_BIT = 0x20000
+
+# SWI numbers are allocated to modules in chunks of this size
+SWI_CHUNK_SIZE = 64
+
+
+class ConstantEvaluator(object):
+    """
+    Evaluate the values of constants, which may be expressions using other constants.
+
+    The values are given as they were parsed: a number, a name, or a list of tokens,
+    which may end in a description of the constant. Each constant is only evaluated
+    once.
+    """
+    # Binary operators, and their precedence (higher binds more tightly)
+    operators = {
+            '|': 1,
+            '<<': 2,
+            '>>': 2,
+            '+': 3,
+            '*': 4,
+        }
+
+    def __init__(self, constants):
+        self.constants = constants
+        self.values = {}
+        self.evaluating = set()
+
+    @classmethod
+    def split(cls, value):
+        """
+        Split a value into its expression and description.
+
+        @return: tuple of (expression, description or None)
+        """
+        if isinstance(value, list) and len(value) > 1 \
+                and isinstance(value[-1], str) and value[-1] != ')' \
+                and not (isinstance(value[-2], str) and value[-2] in cls.operators):
+            description = value[-1]
+            value = value[:-1]
+            if len(value) == 1:
+                value = value[0]
+            return (value, description)
+        return (value, None)
+
+    def constant(self, name):
+        """
+        Return the value of a named constant.
+        """
+        value = self.values.get(name, None)
+        if value is None:
+            if name in self.evaluating:
+                raise ConstantError("Constant %s refers to itself" % (name,))
+            constant = self.constants.get(name, None)
+            if isinstance(constant, TypeRef):
+                constant = constant.dtype
+            if constant is None:
+                value = ConstantError("Constant %s is not known" % (name,))
+            else:
+                self.evaluating.add(name)
+                try:
+                    value = self.evaluate(constant.value)
+                except ConstantError as exc:
+                    value = exc
+                finally:
+                    self.evaluating.discard(name)
+            self.values[name] = value
+
+        if isinstance(value, ConstantError):
+            raise value
+        return value
+
+    def evaluate(self, value):
+        """
+        Return the numeric value of a value, as parsed.
+        """
+        (value, description) = self.split(value)
+        if isinstance(value, list):
+            (result, pos) = self.expression(value, 0, 0)
+            if pos != len(value):
+                raise ConstantError("Cannot evaluate %r" % (value,))
+            return result
+        return self.operand(value)
+
+    def operand(self, value):
+        if isinstance(value, int):
+            return value
+        if isinstance(value, str):
+            if len(value) > 2 and value[0] == "'" and value[-1] == "'":
+                # Characters in a word, with the first in the lowest byte
+                result = 0
+                for index, char in enumerate(value[1:-1]):
+                    result |= ord(char) << (index * 8)
+                return result
+            return self.constant(value)
+        raise ConstantError("Cannot evaluate %r" % (value,))
+
+    def expression(self, tokens, pos, precedence):
+        """
+        Evaluate an expression from a list of tokens.
+
+        @param tokens:      List of tokens
+        @param pos:         Index of the first token of the expression
+        @param precedence:  Lowest precedence of the operators to include
+
+        @return: tuple of (value, index of the token after the expression)
+        """
+        if pos >= len(tokens):
+            raise ConstantError("Expression %r is incomplete" % (tokens,))
+        if tokens[pos] == '(':
+            (result, pos) = self.expression(tokens, pos + 1, 0)
+            if pos >= len(tokens) or tokens[pos] != ')':
+                raise ConstantError("Expression %r has unbalanced brackets" % (tokens,))
+            pos += 1
+        else:
+            result = self.operand(tokens[pos])
+            pos += 1
+
+        while pos < len(tokens):
+            op = tokens[pos]
+            op_precedence = self.operators.get(op, None) if isinstance(op, str) else None
+            if op_precedence is None or op_precedence < precedence:
+                break
+            (rhs, pos) = self.expression(tokens, pos + 1, op_precedence + 1)
+            try:
+                if op == '|':
+                    result = result | rhs
+                elif op == '<<':
+                    result = result << rhs
+                elif op == '>>':
+                    result = result >> rhs
+                elif op == '+':
+                    result = result + rhs
+                else:
+                    result = result * rhs
+            except (ValueError, TypeError) as exc:
+                raise ConstantError("Expression %r cannot be evaluated: %s" % (tokens, exc))
+        return (result, pos)
+
+
+class TypeRef(object):
     """
     A reference to a type, used when constructing the DefMods types list.
     """
+    __slots__ = ('name', 'dtype', 'defmod')
 
     def __init__(self, name, dtype, defmod):
         self.name = name
@@ -1471,7 +3792,7 @@ class TypeRef(object):
 
 
 class ConstantRef(TypeRef):
-    pass
+    __slots__ = ()
 
 
 class DefMods(object):
@@ -1482,14 +3803,31 @@ class DefMods(object):
             'User',
         ]
 
-    def __init__(self, basedir=None):
+    def __init__(self, basedir=None, cache=None, parsed=None):
         self.basedir = basedir
+        self.cache = cache
+        # Parsed modules, by filename, which may be shared between DefMods
+        self.parsed = {} if parsed is None else parsed
         self.found_defmods = None
         self.defmods = []
+        self.filenames = []     # The def files which were loaded
         self.modnames = {}
-        self._all_types = None
-        self._lookup_types = None
-        self._all_constants = None
+        # Indexes of the types and constants from every module, maintained as modules are added
+        self._types = {}
+        self._lookup_types = {}     # Keyed by the lower case name
+        self._constants = {}
+        # Indexes of the module SWIs, by number (without the X bit), lower case name, and chunk,
+        # which are brought up to date when they are used
+        self._swi_numbers = {}
+        self._swi_names = {}
+        self._swi_chunks = {}
+        self._swis_indexed = 0      # Number of modules whose SWIs are in the indexes
+        # Dependencies between the types and constants, built when first needed
+        self._type_graph = None
+        # Layout engines, by ABI name
+        self._layout_engines = {}
+        # Values of the constants, evaluated when first needed
+        self._evaluator = None
 
     def __repr__(self):
         return "<{}({} defmods)>".format(self.__class__.__name__,
@@ -1533,10 +3871,35 @@ class DefMods(object):
         self._collect()
         return self.found_defmods.get(name, None)
 
+    def parse_all(self, filenames=(), jobs=None):
+        """
+        Parse def files in parallel, ready for them to be added.
+
+        The parsed modules are only recorded here; they are added (and their needs
+        followed) in the same way as they would have been without this call.
+
+        @param filenames:   Def files to parse, in addition to all those in the OSLib directory
+        @param jobs:        Number of processes to use, or None for the number of CPUs
+        """
+        self._collect()
+        filenames = list(filenames) + sorted(self.found_defmods.values())
+        self.parsed.update(parse_files_parallel(filenames, jobs=jobs, cache=self.cache,
+                                                exclude=self.parsed))
+
     def add(self, defmodfile, inctype='required'):
-        defmod = parse_file(defmodfile, inctype=inctype)
+        key = os.path.abspath(defmodfile)
+        defmod = self.parsed.get(key)
+        if defmod is None:
+            defmod = parse_file(defmodfile, inctype=inctype, cache=self.cache)
+            self.parsed[key] = defmod
+        elif defmod.inctype != inctype:
+            # Shared with another DefMods, which included it differently
+            defmod = copy.copy(defmod)
+            defmod.inctype = inctype
         self.defmods.append(defmod)
+        self.filenames.append(defmodfile)
         self.modnames[defmod.modname] = defmod
+        self._index(defmod)
 
         for need in defmod.needs:
             need = need.lower()
@@ -1547,53 +3910,185 @@ class DefMods(object):
                 if filename:
                     self.add(filename, inctype='include')
 
-        # Clear the cache
-        self._all_types = None
+    def _index(self, defmod):
+        """
+        Add a module's types and constants to the indexes.
+
+        Later modules take precedence over earlier ones with the same names.
+        """
+        self._type_graph = None
+        self._layout_engines = {}
+        self._evaluator = None
+
+        for name, dtype in defmod.types.items():
+            tref = TypeRef(name=name, dtype=dtype, defmod=defmod)
+            self._types[name] = tref
+            self._lookup_types[type_symbols.lower(name)] = tref
+
+        for name, constant in defmod.constants.items():
+            self._constants[name] = ConstantRef(name=name, dtype=constant, defmod=defmod)
+
+    def _index_swis(self):
+        """
+        Add the SWIs of any modules which have been added since the SWIs were last indexed.
+
+        This is left until the SWIs are looked up, so that the SWIs of included modules
+        need not be parsed otherwise.
+        """
+        while self._swis_indexed < len(self.defmods):
+            defmod = self.defmods[self._swis_indexed]
+            self._swis_indexed += 1
+            for number, swilist in defmod.modswis.items():
+                if number is None:
+                    continue
+                number = number & ~SWI_X_BIT
+                self._swi_numbers.setdefault(number, []).extend(swilist)
+                chunk = self._swi_chunks.setdefault(number & ~(SWI_CHUNK_SIZE - 1), {})
+                chunk.setdefault(number, []).extend(swilist)
+                for swi in swilist:
+                    self._swi_names.setdefault(swi.name.lower(), []).append(swi)
+
+    def lookup_swi(self, swi):
+        """
+        Find the definitions of a SWI.
+
+        Only the module SWIs are included; vectors, services, events and upcalls are not.
+
+        @param swi: SWI number or name, either of which may be for the X form of the SWI
+
+        @return: list of SWI definitions, or an empty list if it is not known
+        """
+        self._index_swis()
+        if isinstance(swi, int):
+            return self._swi_numbers.get(swi & ~SWI_X_BIT, [])
+
+        name = swi.lower()
+        swilist = self._swi_names.get(name)
+        if swilist is None and name.startswith('x'):
+            swilist = self._swi_names.get(name[1:])
+        return swilist or []
+
+    def swi_chunk(self, number):
+        """
+        Find the definitions of the SWIs in a SWI chunk.
+
+        @param number:  The chunk base, or any SWI number within the chunk
+
+        @return: dictionary of SWI number (without the X bit) to list of SWI definitions
+        """
+        self._index_swis()
+        return dict(self._swi_chunks.get(number & ~SWI_X_BIT & ~(SWI_CHUNK_SIZE - 1), {}))
 
     def lookup_type(self, name):
-        name = name.lower()
-        return self.lookup_types.get(name, None)
+        name = type_symbols.lower(name)
+        return self._lookup_types.get(name, None)
 
     @property
     def types(self):
-        if self._all_types is None:
-            self._all_types = {}
-            for defmod in self.defmods:
-                types = dict((name, TypeRef(name=name, dtype=dtype, defmod=defmod)) for name, dtype in defmod.types.items())
-                self._all_types.update(types)
-
-        return self._all_types
+        return self._types
 
     @property
     def lookup_types(self):
-        if self._lookup_types is None:
-            self._lookup_types = {}
-            for defmod in self.defmods:
-                types = dict((name, TypeRef(name=name, dtype=dtype, defmod=defmod)) for name, dtype in defmod.types.items())
-                for name, tref in types.items():
-                    self._lookup_types[name.lower()] = tref
-
         return self._lookup_types
 
     @property
     def constants(self):
-        if self._all_constants is None:
-            self._all_constants = {}
-            for defmod in self.defmods:
-                types = dict((name, ConstantRef(name=name, dtype=dtype, defmod=defmod)) for name, dtype in defmod.constants.items())
-                self._all_constants.update(types)
+        return self._constants
+
+    @property
+    def type_graph(self):
+        if self._type_graph is None:
+            self._type_graph = TypeGraph(self._types, self._constants)
+        return self._type_graph
+
+    def layout_engine(self, abi='aarch32'):
+        engine = self._layout_engines.get(abi, None)
+        if engine is None:
+            engine = LayoutEngine(self, abi)
+            self._layout_engines[abi] = engine
+        return engine
+
+    @property
+    def evaluator(self):
+        if self._evaluator is None:
+            self._evaluator = ConstantEvaluator(self._constants)
+        return self._evaluator
 
-        return self._all_constants
+    def constant_value(self, value, default=None):
+        """
+        Return the numeric value of a constant.
+
+        @param value:   Constant name, or a value as parsed
+        @param default: Value to return if it cannot be evaluated
+
+        @return: the value as an integer, or the default
+        """
+        try:
+            return self.evaluator.evaluate(value)
+        except ConstantError:
+            return default
+
+    def constant_description(self, value):
+        """
+        Return the description given with a constant's value, or None if there is none.
+        """
+        return ConstantEvaluator.split(value)[1]
+
+
+# The outputs which can be generated for the def files given on the command line:
+#   (option name, function)
+single_generators = [
+        ('swi_conditions', write_all_swi_conditions),
+        ('create_message_details', create_message_details),
+        ('create_module_cmhg_template', create_module_cmhg_template),
+        ('create_module_c_template', create_module_c_template),
+        ('create_module_h_template', create_module_h_template),
+        ('create_pymodule_template', create_pymodule_template),
+        ('create_pymodule_constants', create_pymodule_constants),
+        ('create_api_template', create_api_template),
+        ('create_python_api_template', create_python_api_template),
+        ('create_python_struct_api', create_python_struct_api),
+        ('create_aarch64_api', create_aarch64_api),
+        ('create_nvram_constants', create_nvram_constants),
+    ]
+
+
+def find_generator(name):
+    """
+    Return the function for a generator, named as in batch mode or as an output option.
+
+    @param name:    Batch generator name, or output option without the leading '--'
+
+    @return: function called as func(defmods, output), or None if not known
+    """
+    if name in batch_generators:
+        return batch_generators[name][0]
+    for option, func in single_generators:
+        if option.replace('_', '-') == name:
+            return func
+    return None
+
+
+def report_output_stats():
+    print("Outputs: %i written, %i unchanged, %i removed" % (output_stats['written'],
+                                                             output_stats['unchanged'],
+                                                             output_stats['removed']))
 
 
 def setup_argparse():
     parser = argparse.ArgumentParser(usage="%s [<options>] <def-mod-file>*" % (os.path.basename(sys.argv[0]),))
     parser.add_argument('--debug', action='store_true', default=False,
                         help="Enable debugging")
-    parser.add_argument('files', nargs="+",
+    parser.add_argument('files', nargs="*",
                         help="DefMod files to read")
     parser.add_argument('--oslib-dir', action='store', default=None,
                         help="Directory holding OSLib files")
+    parser.add_argument('--cache-dir', action='store', default=None,
+                        help="Directory to cache parsed def files and compiled templates in (default: %s)" % (default_cache_dir(),))
+    parser.add_argument('--no-cache', action='store_true', default=False,
+                        help="Do not use the cache of parsed def files and compiled templates")
+    parser.add_argument('--jobs', '-j', action='store', type=int, default=1,
+                        help="Number of processes to parse def files with (0 for the number of CPUs)")
     parser.add_argument('--swi-conditions', action='store',
                         help="File to write the SWI conditions into")
     parser.add_argument('--create-message-details', action='store',
@@ -1612,10 +4107,35 @@ def setup_argparse():
                         help="File to write a template for an API of the module")
     parser.add_argument('--create-python-api-template', action='store',
                         help="File to write a template for an Python API of the module")
+    parser.add_argument('--create-python-struct-api', action='store',
+                        help="File to write a Python API of the module, using struct formats, into")
     parser.add_argument('--create-aarch64-api', action='store',
                         help="File to write an AArch64 assembler file for an API of the module")
     parser.add_argument('--create-nvram-constants', action='store',
                         help="File to write a constants file for NVRAM (pass OSByte definition)")
+    parser.add_argument('--depfile', action='store',
+                        help="File to write make dependencies of the outputs into")
+    parser.add_argument('--output-dir', action='store',
+                        help="Directory to write per-module outputs to for each def file, in batch mode")
+    parser.add_argument('--generate', action='append', choices=sorted(batch_generators),
+                        help="Generator to use in batch mode (default: all)")
+    parser.add_argument('--manifest', action='store',
+                        help="File to record the inputs of each output in, in batch mode "
+                             "(default: kept in the cache directory, for each output directory)")
+    parser.add_argument('--force', action='store_true', default=False,
+                        help="Generate all the outputs in batch mode, even if their inputs are unchanged")
+    parser.add_argument('--output-pattern', action='append', default=[],
+                        help="Output filename within the output directory for a generator in batch mode, "
+                             "as <generator>=<pattern>, where {name} is the def file name")
+    parser.add_argument('--watch', action='store_true', default=False,
+                        help="Keep running, and regenerate the outputs whose def files or templates change")
+    parser.add_argument('--watch-interval', action='store', type=float, default=1.0,
+                        help="Time between checks for changed files in watch mode, in seconds (default: 1)")
+    parser.add_argument('--serve', action='store', metavar='SOCKET',
+                        help="Keep the modules of the OSLib directory loaded, and generate outputs "
+                             "for clients which connect to the given Unix domain socket")
+    parser.add_argument('--client', action='store', metavar='SOCKET',
+                        help="Ask the server on the given Unix domain socket to generate the outputs")
 
     return parser
 
@@ -1626,10 +4146,108 @@ def main():
     options = parser.parse_args()
 
     global debug
+    global templates_cache_dir
     debug = options.debug
 
-    defmods = DefMods(basedir=options.oslib_dir)
+    cache = None
+    if not options.no_cache:
+        cache = ParseCache(options.cache_dir or default_cache_dir())
+        templates_cache_dir = os.path.join(cache.path, 'templates')
+
+    jobs = options.jobs or None
+
+    if options.serve:
+        server = GenerationServer(options.serve, basedir=options.oslib_dir, cache=cache, jobs=jobs)
+        try:
+            # Checked before loading, as well as when the server starts listening
+            server.check_socket()
+            server.load()
+            server.serve()
+        except ServerError as exc:
+            print("Cannot serve: %s" % (exc,))
+            return 1
+        return
+
+    if not options.files:
+        parser.error("At least one def file must be given")
+
+    patterns = {}
+    for output_pattern in options.output_pattern:
+        (generator, _, pattern) = output_pattern.partition('=')
+        if generator not in batch_generators or not pattern:
+            parser.error("Output pattern '%s' is not understood" % (output_pattern,))
+        patterns[generator] = pattern
+
+    if options.output_dir:
+        single = ['--' + option.replace('_', '-')
+                  for option, func in single_generators if getattr(options, option)]
+        if single:
+            parser.error("%s cannot be used with --output-dir; use --generate in batch mode"
+                         % (', '.join(single),))
+
+    if options.client:
+        def abspath(filename):
+            return filename and os.path.abspath(filename)
+
+        request = {
+                'files': [abspath(name) if os.path.isfile(name) else name for name in options.files],
+                'oslib_dir': abspath(options.oslib_dir),
+                'depfile': abspath(options.depfile),
+            }
+        if options.output_dir:
+            request.update({
+                    'output_dir': abspath(options.output_dir),
+                    'generators': options.generate,
+                    'patterns': patterns,
+                    'manifest': abspath(options.manifest),
+                    'force': options.force,
+                })
+        else:
+            request['generate'] = [(option.replace('_', '-'), abspath(getattr(options, option)))
+                                   for option, func in single_generators if getattr(options, option)]
+        try:
+            response = send_request(options.client, request)
+        except (IOError, OSError) as exc:
+            print("Cannot use the server on %s: %s" % (options.client, exc))
+            return 1
+        sys.stdout.write(response['output'])
+        return response['status'] or None
+
+    if options.output_dir:
+        manifest = None
+        manifest_file = options.manifest or default_manifest_file(cache, options.output_dir)
+        if manifest_file:
+            manifest = BuildManifest(manifest_file, load=not options.force)
+        parsed = {}
+        failed = generate_batch(options.files, options.output_dir,
+                                generators=options.generate, patterns=patterns,
+                                oslib_dir=options.oslib_dir, cache=cache, jobs=jobs,
+                                manifest=manifest, parsed=parsed)
+        if options.depfile:
+            write_depfile(options.depfile, output_dependencies)
+        report_output_stats()
+
+        if options.watch:
+            watcher = Watcher(parsed=parsed, cache=cache, interval=options.watch_interval)
+            for plan in plan_batch(options.files, options.output_dir,
+                                   generators=options.generate, patterns=patterns,
+                                   oslib_dir=options.oslib_dir):
+                (defmodfile, name, generator, func, basedir, output) = plan
+                watcher.add_output(output, [defmodfile], basedir, func,
+                                   inputs=output_dependencies.get(output))
+            watcher.run()
+            return
+
+        if failed:
+            print("%i failures whilst generating outputs" % (failed,))
+            return 1
+        return
 
+    defmods = DefMods(basedir=options.oslib_dir, cache=cache)
+    if jobs != 1:
+        defmods.parse_all(options.files, jobs=jobs)
+
+    files = []
     for defmodfile in options.files:
         if not os.path.isfile(defmodfile):
             filename = defmods.resolve(defmodfile.lower())
@@ -1637,6 +4255,7 @@ def main():
                 defmodfile = filename
         print("Reading %s" % (defmodfile,))
         defmods.add(defmodfile)
+        files.append(defmodfile)
 
         #try:
         #    defmods.add(defmodfile)
@@ -1645,38 +4264,24 @@ def main():
         #except Exception as exc:
         #    print("  Failed %s: %s: %s" % (defmodfile, exc.__class__.__name__, exc))
 
-    if options.swi_conditions:
-        write_all_swi_conditions(defmods, options.swi_conditions)
-
-    if options.create_message_details:
-        create_message_details(defmods, options.create_message_details)
-
-    if options.create_module_cmhg_template:
-        create_module_template(defmods, options.create_module_cmhg_template, 'cmhg')
-
-    if options.create_module_c_template:
-        create_module_template(defmods, options.create_module_c_template, 'c')
-
-    if options.create_module_h_template:
-        create_module_template(defmods, options.create_module_h_template, 'h')
-
-    if options.create_pymodule_template:
-        create_pymodule_template(defmods, options.create_pymodule_template)
-
-    if options.create_pymodule_constants:
-        create_pymodule_constants(defmods, options.create_pymodule_constants)
-
-    if options.create_api_template:
-        create_api_template(defmods, options.create_api_template)
+    outputs = []
+    for option, func in single_generators:
+        output = getattr(options, option)
+        if output:
+            func(defmods, output)
+            outputs.append((output, func))
 
-    if options.create_python_api_template:
-        create_python_api_template(defmods, options.create_python_api_template)
+    if options.depfile:
+        write_depfile(options.depfile, output_dependencies)
 
-    if options.create_aarch64_api:
-        create_aarch64_api(defmods, options.create_aarch64_api)
+    report_output_stats()
 
-    if options.create_nvram_constants:
-        create_nvram_constants(defmods, options.create_nvram_constants)
+    if options.watch:
+        watcher = Watcher(parsed=defmods.parsed, cache=cache, interval=options.watch_interval)
+        for output, func in outputs:
+            watcher.add_output(output, files, options.oslib_dir, func, defmods=defmods,
+                               inputs=output_dependencies.get(output))
+        watcher.run()
 
 
 if __name__ == '__main__':